@@ -0,0 +1,216 @@
+import argparse
+import importlib.util
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import requests
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='COVID19 patients Summary benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    status_parser = subparsers.add_parser('status', help='Compare apply(get_status) with get_statuses')
+    status_parser.add_argument('-d', '--days', default=3650, type=int, help='Number of days of the synthetic series')
+    status_parser.add_argument('-m', '--missing-rate', default=0.1, type=float, help='Rate of days without patients')
+    status_parser.add_argument('-n', '--repeat', default=3, type=int, help='Number of repetitions')
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Time each stage of the summary pipeline')
+    pipeline_parser.add_argument('-r', '--rows', type=int, action='append',
+                                 help='Number of rows of the synthetic CSV (default: 10000, 1000000, 10000000)')
+    pipeline_parser.add_argument('-d', '--days', default=1000, type=int, help='Number of days of the synthetic CSV')
+    pipeline_parser.add_argument('-w', '--workdir', required=False,
+                                 help='Directory of the synthetic CSV files (reused if exist)')
+    pipeline_parser.add_argument('-t', '--templatefile', default=default_template_file(), help='Template filename')
+    pipeline_parser.add_argument('--no-memory', action='store_true', help='Do not trace peak memory')
+
+    generate_parser = subparsers.add_parser('generate', help='Generate a synthetic patients CSV')
+    generate_parser.add_argument('-r', '--rows', default=10000, type=int, help='Number of rows')
+    generate_parser.add_argument('-d', '--days', default=1000, type=int, help='Number of days')
+    generate_parser.add_argument('-o', '--output', required=True, help='Output CSV filename')
+
+    args = parser.parse_args()
+    if args.command == 'status':
+        benchmark_status(args.days, args.missing_rate, args.repeat)
+    elif args.command == 'pipeline':
+        workdir = args.workdir or tempfile.mkdtemp(prefix='covid19-benchmark-')
+        benchmark_pipeline(args.rows or [10000, 1000000, 10000000], args.days, workdir,
+                           args.templatefile, not args.no_memory)
+    else:
+        generate_patients_csv(args.output, args.rows, args.days)
+
+
+# 行毎の apply(get_status) と一括処理の get_statuses の処理時間を比較する
+def benchmark_status(days, missing_rate, repeat):
+    summary = load_module('covid19_summary', 'covid19-summary.py')
+    number_of_patients = generate_number_of_patients(days, missing_rate)
+    print(f'Days : {days} ({len(number_of_patients)} rows)')
+
+    expected = number_of_patients.apply(summary.get_status, args=(number_of_patients,), axis=1)
+    actual = summary.get_statuses(number_of_patients)
+    if not expected.equals(actual.rename(None)):
+        raise AssertionError('get_statuses() differs from get_status()')
+
+    apply_time = measure(lambda: number_of_patients.apply(summary.get_status, args=(number_of_patients,), axis=1),
+                         repeat)
+    vectorized_time = measure(lambda: summary.get_statuses(number_of_patients), repeat)
+    print(f'apply(get_status) : {apply_time:.4f} sec')
+    print(f'get_statuses      : {vectorized_time:.4f} sec')
+    print(f'speedup           : {apply_time / vectorized_time:.1f}x')
+
+
+# 合成した CSV をローカルのサーバーから配信し、集計処理の段階毎の処理時間とピークメモリを出力する
+def benchmark_pipeline(rows_list, days, workdir, template_file, trace_memory):
+    summary = load_module('covid19_summary', 'covid19-summary.py')
+    stub_server = load_module('covid19_stub_server', 'covid19-stub-server.py')
+
+    os.makedirs(workdir, exist_ok=True)
+    server, base_url = stub_server.start_server(workdir)
+    results = []
+    try:
+        for rows in rows_list:
+            filename = f'patients-{rows}-{days}.csv'
+            if not os.path.exists(os.path.join(workdir, filename)):
+                print(f'Generating {filename} ...')
+                generate_patients_csv(os.path.join(workdir, filename), rows, days)
+
+            stages = PipelineStages(summary, base_url + filename, template_file)
+            for name in PipelineStages.STAGES:
+                elapsed, peak = run_stage(getattr(stages, name), trace_memory)
+                results.append((rows, name, elapsed, peak))
+                print_result(rows, name, elapsed, peak)
+            stages = None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print()
+    print(f'{"rows":>12} {"stage":<16} {"sec":>10} {"peak MiB":>10} {"rows/sec":>14}')
+    for rows, name, elapsed, peak in results:
+        print_result(rows, name, elapsed, peak)
+
+
+class PipelineStages:
+    """
+    covid19-summary.py の集計処理を段階毎に分けたもの
+    各段階は前の段階の結果を使う
+    """
+    STAGES = ['download', 'read_csv', 'to_datetime', 'groupby', 'status', 'calendar_weeks', 'render']
+
+    def __init__(self, summary, url, template_file):
+        self.summary = summary
+        self.url = url
+        self.template_file = template_file
+
+    def download(self):
+        self.content = requests.get(self.url).content
+
+    def read_csv(self):
+        self.df = pd.read_csv(io.BytesIO(self.content), encoding='shift-jis', encoding_errors='ignore')
+        self.content = None
+
+    def to_datetime(self):
+        self.df['Date'] = pd.to_datetime(self.df[self.summary.DATE_COLUMN])
+
+    def groupby(self):
+        self.number_of_patients = self.df.groupby('Date').size() \
+            .reset_index(name='Count') \
+            .set_index('Date')
+        self.df = None
+
+    def status(self):
+        self.number_of_patients['Status'] = self.summary.get_statuses(self.number_of_patients)
+
+    def calendar_weeks(self):
+        self.data = self.summary.template_data(self.number_of_patients)
+
+    def render(self):
+        self.html = self.summary.load_template(self.template_file).render(self.data)
+
+
+# 処理時間 (秒) とピークメモリ (バイト) を返す
+def run_stage(func, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def print_result(rows, name, elapsed, peak):
+    peak_mib = f'{peak / 1024 / 1024:.1f}' if peak is not None else '-'
+    print(f'{rows:>12,} {name:<16} {elapsed:>10.3f} {peak_mib:>10} {rows / elapsed:>14,.0f}')
+
+
+# 陽性患者属性の CSV (Shift-JIS) を生成する
+#   公表日は 2020/1/1 から days 日間に行数を振り分け、古い日付から順に並べる
+def generate_patients_csv(output, rows, days, seed=0, chunksize=1000000):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-01', periods=days, freq='D').strftime('%Y/%m/%d').to_numpy()
+    wards = np.array(['北九州市小倉北区', '北九州市小倉南区', '北九州市八幡東区', '北九州市八幡西区',
+                      '北九州市戸畑区', '北九州市門司区', '北九州市若松区'])
+    ages = np.array(['10歳未満', '10代', '20代', '30代', '40代', '50代', '60代', '70代', '80代', '90代'])
+    sexes = np.array(['男性', '女性'])
+
+    date_indexes = np.sort(rng.integers(0, days, rows))
+    with open(output, 'wt', encoding='shift-jis', newline='') as f:
+        for start in range(0, rows, chunksize):
+            n = min(chunksize, rows - start)
+            df = pd.DataFrame({
+                'No': np.arange(start + 1, start + n + 1),
+                '全国地方公共団体コード': 401005,
+                '都道府県名': '福岡県',
+                '市区町村名': '北九州市',
+                '公表_年月日': dates[date_indexes[start:start + n]],
+                '患者_居住地': wards[rng.integers(0, len(wards), n)],
+                '患者_年代': ages[rng.integers(0, len(ages), n)],
+                '患者_性別': sexes[rng.integers(0, len(sexes), n)],
+            })
+            df.to_csv(f, index=False, header=(start == 0))
+
+
+# スクリプトと同じディレクトリのファイルをモジュールとして読み込む (ファイル名に '-' を含むため import 文は使えない)
+def load_module(name, filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def default_template_file():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'covid19-summary-template.html')
+
+
+# 日付の抜けを含む日毎の感染者数データを生成する
+def generate_number_of_patients(days, missing_rate, seed=0):
+    rng = random.Random(seed)
+    dates = pd.date_range('2020-01-01', periods=days, freq='D')
+    dates = dates[[rng.random() >= missing_rate for _ in range(days)]]
+    counts = [rng.randint(1, 500) for _ in range(len(dates))]
+    return pd.DataFrame({'Count': counts}, index=pd.Index(dates, name='Date'))
+
+
+# 指定された処理の実行時間 (最小値) を返す
+def measure(func, repeat):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    main()
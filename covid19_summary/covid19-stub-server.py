@@ -0,0 +1,82 @@
+import argparse
+import email.utils
+import hashlib
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Local stand-in of the open data server')
+    parser.add_argument('-d', '--directory', default='.', help='Directory to serve')
+    parser.add_argument('-b', '--bind', default='127.0.0.1', help='Bind address')
+    parser.add_argument('-p', '--port', default=8000, type=int, help='Port no')
+    args = parser.parse_args()
+
+    server = create_server(args.directory, args.bind, args.port)
+    print(f'Serving {args.directory} at http://{args.bind}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# ETag / Last-Modified を返し、条件付きリクエストに 304 Not Modified で応答するハンドラ
+class ConditionalRequestHandler(SimpleHTTPRequestHandler):
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        st = os.stat(path)
+        etag = '"{}"'.format(hashlib.sha1(f'{st.st_size}-{st.st_mtime_ns}'.encode()).hexdigest())
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.server.request_count += 1
+
+        if self.headers.get('If-None-Match') == etag \
+                or (self.headers.get('If-None-Match') is None
+                    and self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return None
+
+        f = open(path, 'rb')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(st.st_size))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return f
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+# 指定されたディレクトリを配信するサーバーを作成する (port=0 の場合は空いているポートを使う)
+def create_server(directory, bind='127.0.0.1', port=0, quiet=False):
+    def handler(*args, **kwargs):
+        return ConditionalRequestHandler(*args, directory=directory, **kwargs)
+
+    server = ThreadingHTTPServer((bind, port), handler)
+    server.request_count = 0
+    server.quiet = quiet
+    return server
+
+
+# サーバーをバックグラウンドのスレッドで起動し、(server, base_url) を返す
+def start_server(directory, quiet=True):
+    server = create_server(directory, quiet=quiet)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_port}/'
+
+
+if __name__ == "__main__":
+    main()
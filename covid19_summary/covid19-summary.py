@@ -1,39 +1,656 @@
 import requests
 import io
+import os
+import json
+import hashlib
+import functools
+import numpy as np
 import pandas as pd
 from datetime import date, datetime, timedelta
 from jinja2 import Template
 import argparse
+import sys
+import time
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CACHE_CSV_FILENAME = 'patients.csv'
+CACHE_META_FILENAME = 'patients.json'
+CACHE_COUNTS_FILENAME = 'counts.npz'
+HASH_BLOCK_SIZE = 1024 * 1024
+DATE_COLUMN = '公表_年月日'
+BREAKDOWN_COLUMNS = {
+    'age': '患者_年代',
+    'sex': '患者_性別',
+    'residence': '患者_居住地',
+}
+UNKNOWN_CATEGORY = '不明'
+DAYBOX_CLASSES = ['daybox', 'daybox', 'daybox', 'daybox', 'daybox', 'daybox', 'daybox']
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
 
     parser = argparse.ArgumentParser(description='COVID19 patients Summary')
     parser.add_argument('-u', '--url', required=True)
     parser.add_argument('-f', '--htmlfile', required=True)
     parser.add_argument('-t', '--templatefile', required=True)
+    parser.add_argument('-c', '--cache-dir', required=False, help='Cache directory of the patients CSV')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Count only rows appended since the last run (requires --cache-dir)')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Read the patients CSV in chunks with bounded memory')
+    parser.add_argument('--chunksize', default=100000, type=int, help='Number of rows per chunk in --stream mode')
+    parser.add_argument('--date-format', default='%Y/%m/%d', help='Date format of the CSV in --stream mode')
+    parser.add_argument('--breakdown', choices=list(BREAKDOWN_COLUMNS), action='append',
+                        help='Count patients per day by this attribute')
+    parser.add_argument('--rolling', type=int, action='append', help='Window in days of the rolling average')
+    parser.add_argument('--view', nargs=2, action='append', metavar=('TEMPLATEFILE', 'HTMLFILE'),
+                        help='Additional view rendered from the same aggregation')
     args = parser.parse_args()
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental requires --cache-dir')
+    multi_metric = args.breakdown or args.rolling or args.view
+    if multi_metric and (args.incremental or args.stream):
+        parser.error('--breakdown, --rolling and --view cannot be used with --incremental or --stream')
+
+    chunksize = args.chunksize if args.stream else None
+    date_format = args.date_format if args.stream else None
 
     print(args.url)
     print(args.htmlfile)
 
-    # 感染者の CSV データを取り込んで pandas で読み込む
-    res = requests.get(args.url)
-    df = pd.read_csv(io.BytesIO(res.content), encoding='shift-jis', encoding_errors='ignore')
-    df['Date'] = pd.to_datetime(df['公表_年月日'])
+    aggregation = None
+    if multi_metric:
+        # 公表日と内訳の属性の列を 1 度だけ読み込み、全ての集計を行う
+        if args.cache_dir:
+            download_patients_csv(args.url, args.cache_dir)
+            csv = os.path.join(args.cache_dir, CACHE_CSV_FILENAME)
+        else:
+            csv = io.BytesIO(requests.get(args.url).content)
+        aggregation = aggregate_patients(csv, args.breakdown or [], args.rolling or [])
+        number_of_patients = aggregation['number_of_patients']
+        number_of_patients['Status'] = get_statuses(number_of_patients)
+    elif args.cache_dir:
+        number_of_patients = get_cached_number_of_patients(args.url, args.cache_dir, args.incremental,
+                                                           chunksize, date_format)
+    elif args.stream:
+        # 感染者の CSV データを受信しながら少しずつ読み込む
+        with requests.get(args.url, stream=True) as res:
+            res.raise_for_status()
+            res.raw.decode_content = True
+            res.raw.auto_close = False
+            csv = io.TextIOWrapper(res.raw, encoding='shift-jis', errors='ignore')
+            number_of_patients = count_patients(csv, chunksize, date_format)
 
-    # 日付ごとにデータの件数を数える
-    number_of_patients = df.groupby('Date').size() \
-        .reset_index(name='Count') \
-        .set_index('Date')
+        number_of_patients['Status'] = get_statuses(number_of_patients)
+    else:
+        # 感染者の CSV データを取り込んで pandas で読み込む
+        res = requests.get(args.url)
+        number_of_patients = count_patients(io.BytesIO(res.content))
 
-    # 前週の同一曜日と比較した状態を設定する
-    number_of_patients['Status'] = number_of_patients.apply(get_status, args=(number_of_patients,), axis=1)
+        # 前週の同一曜日と比較した状態を設定する
+        number_of_patients['Status'] = get_statuses(number_of_patients)
 
-    html = generate_html(number_of_patients, args.templatefile)
+    html = generate_html(number_of_patients, args.templatefile, aggregation)
     with open(args.htmlfile, 'wt') as f:
         f.write(html)
 
+    for templatefile, htmlfile in args.view or []:
+        print(htmlfile)
+        html = generate_html(number_of_patients, templatefile, aggregation)
+        with open(htmlfile, 'wt') as f:
+            f.write(html)
+
+
+# マニフェストに記載された複数の CSV からそれぞれの HTML をまとめて生成する
+#   CSV のダウンロードはスレッドプールで並行に行い、集計と HTML の生成はプロセスプールで行う
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='covid19-summary.py batch',
+                                     description='COVID19 patients Summary (batch)')
+    parser.add_argument('manifest', help='Manifest file (JSON or YAML list of url, template, output)')
+    parser.add_argument('-c', '--cache-dir', required=False, help='Cache directory of the patients CSV')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Count only rows appended since the last run (requires --cache-dir)')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Read the cached patients CSV in chunks with bounded memory (requires --cache-dir)')
+    parser.add_argument('--chunksize', default=100000, type=int, help='Number of rows per chunk in --stream mode')
+    parser.add_argument('--date-format', default='%Y/%m/%d', help='Date format of the CSV in --stream mode')
+    parser.add_argument('--fetch-jobs', default=8, type=int, help='Number of concurrent downloads')
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int,
+                        help='Number of processes for aggregation and rendering')
+    args = parser.parse_args(argv)
+    if (args.incremental or args.stream) and not args.cache_dir:
+        parser.error('--incremental and --stream require --cache-dir')
+
+    chunksize = args.chunksize if args.stream else None
+    date_format = args.date_format if args.stream else None
+
+    sources = load_manifest(args.manifest)
+    print(f'Manifest : {args.manifest} ({len(sources)} sources)')
+
+    # 同じ URL のソースは 1 度だけダウンロード・集計し、その結果からそれぞれの HTML を出力する
+    #   (同じキャッシュディレクトリを複数のスレッド・プロセスで同時に更新しないようにする)
+    groups = {}
+    for source in sources:
+        groups.setdefault(source['url'], []).append(source)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.fetch_jobs) as fetcher, \
+            ProcessPoolExecutor(max_workers=args.jobs) as builder:
+        def fetch_and_submit(url, group):
+            cache_dir = source_cache_dir(args.cache_dir, url)
+            fetch_start = time.perf_counter()
+            fetched = fetch_source(url, cache_dir)
+            fetch_time = time.perf_counter() - fetch_start
+            return fetch_time, builder.submit(build_reports, group, fetched, cache_dir,
+                                              args.incremental, chunksize, date_format)
+
+        fetches = [fetcher.submit(fetch_and_submit, url, group) for url, group in groups.items()]
+        failed = 0
+        for (url, group), fetch in zip(groups.items(), fetches):
+            try:
+                fetch_time, report = fetch.result()
+                aggregate_time, render_results = report.result()
+            except Exception as e:
+                print(f'{url} : failed ({e})')
+                failed += len(group)
+                continue
+            for source, (render_time, error) in zip(group, render_results):
+                if error:
+                    print(f'{source["output"]} : failed ({error})')
+                    failed += 1
+                    continue
+                print(f'{source["output"]} : fetch {fetch_time:.3f} sec, aggregate {aggregate_time:.3f} sec, '
+                      f'render {render_time:.3f} sec')
+
+    print(f'Total : {time.perf_counter() - start:.3f} sec ({len(sources) - failed} succeeded, {failed} failed)')
+    if failed:
+        sys.exit(1)
+
+
+# マニフェストファイル (JSON または YAML) を読み込む
+#   [{"url": ..., "template": ..., "output": ...}, ...]
+def load_manifest(manifest_file):
+    with open(manifest_file, 'rt', encoding='utf8') as f:
+        if os.path.splitext(manifest_file)[1].lower() in ('.yml', '.yaml'):
+            import yaml
+            sources = yaml.safe_load(f)
+        else:
+            sources = json.load(f)
+
+    for n, source in enumerate(sources):
+        for key in ('url', 'template', 'output'):
+            if key not in source:
+                raise ValueError(f'{manifest_file} : "{key}" is missing in source #{n + 1}')
+    return sources
+
+
+# URL 毎のキャッシュディレクトリを返す
+def source_cache_dir(cache_dir, url):
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest()[:16])
+
+
+# CSV をダウンロードする
+#   キャッシュディレクトリが指定された場合は条件付きでダウンロードしてキャッシュを更新し、
+#   ダウンロードしたかどうか (True / False) を返す
+#   指定されていない場合は CSV の内容を返す
+def fetch_source(url, cache_dir):
+    if cache_dir:
+        return download_patients_csv(url, cache_dir)
+
+    res = requests.get(url)
+    res.raise_for_status()
+    return res.content
+
+
+# ダウンロードした CSV を集計し、同じ CSV を使うソース毎に HTML ファイルを出力する
+#   (集計の処理時間, [(HTML 生成の処理時間, エラー (成功した場合は None)), ...]) を返す
+#   (プロセスプールのワーカーで実行する)
+def build_reports(sources, fetched, cache_dir, incremental=False, chunksize=None, date_format=None):
+    start = time.perf_counter()
+    if cache_dir:
+        number_of_patients = get_cached_number_of_patients(sources[0]['url'], cache_dir, incremental,
+                                                           chunksize, date_format, downloaded=fetched)
+    else:
+        number_of_patients = count_patients(io.BytesIO(fetched))
+        number_of_patients['Status'] = get_statuses(number_of_patients)
+    aggregate_time = time.perf_counter() - start
+
+    render_results = []
+    for source in sources:
+        render_start = time.perf_counter()
+        try:
+            html = generate_html(number_of_patients, source['template'])
+            with open(source['output'], 'wt') as f:
+                f.write(html)
+        except Exception as e:
+            render_results.append((None, str(e)))
+            continue
+        render_results.append((time.perf_counter() - render_start, None))
+    return aggregate_time, render_results
+
+
+# 集計結果と HTML をメモリ上に保持し、定期的に更新しながらローカルの HTTP サーバーで配信する
+#   更新はバックグラウンドのスレッドで行い、リクエストの処理では集計も HTML 生成も行わない
+def serve_main(argv):
+    parser = argparse.ArgumentParser(prog='covid19-summary.py serve',
+                                     description='COVID19 patients Summary (serve)')
+    parser.add_argument('-u', '--url', required=True)
+    parser.add_argument('-t', '--templatefile', required=True)
+    parser.add_argument('-c', '--cache-dir', required=False, help='Cache directory of the patients CSV')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Count only rows appended since the last run (requires --cache-dir)')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Read the patients CSV in chunks with bounded memory')
+    parser.add_argument('--chunksize', default=100000, type=int, help='Number of rows per chunk in --stream mode')
+    parser.add_argument('--date-format', default='%Y/%m/%d', help='Date format of the CSV in --stream mode')
+    parser.add_argument('--interval', default=600, type=int, help='Refresh interval in seconds')
+    parser.add_argument('-b', '--bind', default='127.0.0.1', help='Bind address')
+    parser.add_argument('-p', '--port', default=8000, type=int, help='Port no')
+    args = parser.parse_args(argv)
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental requires --cache-dir')
+
+    report = SummaryReport(args.url, args.templatefile, args.cache_dir, args.incremental,
+                           args.chunksize if args.stream else None, args.date_format if args.stream else None)
+    report.refresh()
+
+    stop = threading.Event()
+    refresher = threading.Thread(target=report.refresh_periodically, args=(args.interval, stop), daemon=True)
+    refresher.start()
+
+    server = ThreadingHTTPServer((args.bind, args.port), SummaryRequestHandler)
+    server.report = report
+    print(f'Serving {args.url} at http://{args.bind}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+class SummaryReport:
+    """
+    メモリ上に保持するレポート
+
+    Attributes
+    ----------
+    page : tuple
+        (HTML, gzip 圧縮した HTML, ETag, gzip 圧縮した HTML の ETag)
+        更新時は新しいタプルに丸ごと置き換える
+    """
+    def __init__(self, url, template_file, cache_dir=None, incremental=False, chunksize=None, date_format=None):
+        self.url = url
+        self.template_file = template_file
+        self.cache_dir = cache_dir
+        self.incremental = incremental
+        self.chunksize = chunksize
+        self.date_format = date_format
+        self.number_of_patients = None
+        self.validators = {}
+        self.page = None
+
+    def refresh(self):
+        """
+        CSV を条件付きで取得して集計結果を更新し、HTML を生成し直す
+        """
+        self.number_of_patients = self.__get_number_of_patients()
+
+        body = generate_html(self.number_of_patients, self.template_file).encode('utf8')
+        digest = hashlib.sha1(body).hexdigest()
+        self.page = (body, gzip.compress(body), f'"{digest}"', f'"{digest}-gzip"')
+
+    def refresh_periodically(self, interval, stop):
+        """
+        stop がセットされるまで interval 秒毎に refresh を呼び出す
+        失敗した場合はそれまでの HTML を配信し続ける
+        """
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'{self.url} : refresh failed ({e})')
+
+    def __get_number_of_patients(self):
+        if self.cache_dir:
+            downloaded = download_patients_csv(self.url, self.cache_dir)
+            if not downloaded and self.number_of_patients is not None:
+                return self.number_of_patients
+            return get_cached_number_of_patients(self.url, self.cache_dir, self.incremental,
+                                                 self.chunksize, self.date_format, downloaded=downloaded)
+
+        headers = {}
+        if self.number_of_patients is not None:
+            if self.validators.get('etag'):
+                headers['If-None-Match'] = self.validators['etag']
+            if self.validators.get('last_modified'):
+                headers['If-Modified-Since'] = self.validators['last_modified']
+
+        with requests.get(self.url, headers=headers, stream=True) as res:
+            if res.status_code == 304:
+                return self.number_of_patients
+            res.raise_for_status()
+
+            if self.chunksize:
+                res.raw.decode_content = True
+                res.raw.auto_close = False
+                csv = io.TextIOWrapper(res.raw, encoding='shift-jis', errors='ignore')
+                number_of_patients = count_patients(csv, self.chunksize, self.date_format)
+            else:
+                number_of_patients = count_patients(io.BytesIO(res.content))
+            self.validators = {
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+            }
+
+        number_of_patients['Status'] = get_statuses(number_of_patients)
+        return number_of_patients
+
+
+# メモリ上の HTML を返すハンドラ
+class SummaryRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.__send_page(True)
+
+    def do_HEAD(self):
+        self.__send_page(False)
+
+    def __send_page(self, with_body):
+        if self.path.split('?')[0] not in ('/', '/index.html'):
+            self.send_error(404)
+            return
+
+        # ETag は gzip 圧縮した HTML と圧縮していない HTML で別の値にする
+        body, gzip_body, etag, gzip_etag = self.server.report.page
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if use_gzip:
+            body, etag = gzip_body, gzip_etag
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+
+# 感染者の CSV データを読み込み、日付ごとにデータの件数を数える
+#   chunksize が指定された場合は公表日の列だけを chunksize 行ずつ読み込んで件数を足し合わせていく
+#   (メモリ使用量は CSV の大きさによらず一定)
+#   names が指定された場合は CSV に見出し行が無いものとして names を列名にする
+def count_patients(csv, chunksize=None, date_format=None, names=None):
+    header = 0 if names is None else None
+    if chunksize is None:
+        df = pd.read_csv(csv, encoding='shift-jis', encoding_errors='ignore', header=header, names=names)
+        df['Date'] = pd.to_datetime(df[DATE_COLUMN], format=date_format)
+
+        return df.groupby('Date').size() \
+            .reset_index(name='Count') \
+            .set_index('Date')
+
+    counts = pd.Series(dtype='int64')
+    with pd.read_csv(csv, encoding='shift-jis', encoding_errors='ignore', header=header, names=names,
+                     usecols=[DATE_COLUMN], dtype=str, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk_counts = pd.to_datetime(chunk[DATE_COLUMN], format=date_format).value_counts()
+            counts = counts.add(chunk_counts, fill_value=0)
+
+    counts = counts.sort_index().astype('int64')
+    return pd.DataFrame({'Count': counts.to_numpy()}, index=pd.DatetimeIndex(counts.index, name='Date'))
+
+
+# 感染者の CSV データを 1 度だけ読み込み、日付ごとの件数・属性別の件数・移動平均をまとめて集計する
+#   公表日と属性の列だけをカテゴリ型で読み込み、(日付, 属性...) の組み合わせ毎の件数を 1 回の groupby で求め、
+#   属性別の件数と移動平均はその小さな集計結果から求める
+#   属性が空欄の患者は '不明' として数える
+#     number_of_patients : 日付ごとの件数 (Count)
+#     breakdowns         : {属性: 日付 x 属性値の件数の DataFrame}
+#     rolling_averages   : 日付 x 移動平均 (Rolling7 など) の DataFrame (日付の抜けは 0 件として計算)
+def aggregate_patients(csv, breakdowns, windows):
+    columns = [BREAKDOWN_COLUMNS[breakdown] for breakdown in breakdowns]
+    df = pd.read_csv(csv, encoding='shift-jis', encoding_errors='ignore', usecols=[DATE_COLUMN] + columns,
+                     dtype={column: 'category' for column in columns})
+    df['Date'] = pd.to_datetime(df[DATE_COLUMN])
+    for column in columns:
+        # データに '不明' が既に含まれている場合はカテゴリを追加しない
+        if UNKNOWN_CATEGORY not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories([UNKNOWN_CATEGORY])
+        df[column] = df[column].fillna(UNKNOWN_CATEGORY)
+
+    grouped = df.groupby(['Date'] + columns, observed=True).size()
+    counts = grouped.groupby(level='Date').sum()
+    number_of_patients = pd.DataFrame({'Count': counts.astype('int64')})
+
+    aggregation = {
+        'number_of_patients': number_of_patients,
+        'breakdowns': {},
+        'rolling_averages': pd.DataFrame(index=counts.index),
+    }
+    for breakdown, column in zip(breakdowns, columns):
+        aggregation['breakdowns'][breakdown] = grouped.groupby(level=['Date', column], observed=True).sum() \
+            .unstack(fill_value=0)
+
+    daily_counts = counts.reindex(pd.date_range(counts.index.min(), counts.index.max(), freq='D'), fill_value=0)
+    for window in windows:
+        aggregation['rolling_averages'][f'Rolling{window}'] = \
+            daily_counts.rolling(window, min_periods=1).mean().reindex(counts.index)
+    return aggregation
+
+
+# 集計結果から日付毎の表の見出しと行を返す (新しい日付から順に並べる)
+#   行は (日付の表示, [件数・移動平均・属性別の件数の表示...]) のタプル
+def breakdown_table(aggregation):
+    table = aggregation['number_of_patients'][['Count']].join(aggregation['rolling_averages'])
+    for breakdown, counts in aggregation['breakdowns'].items():
+        table = table.join(counts.add_prefix(f'{breakdown}:'))
+    table = table.sort_index(ascending=False)
+
+    headings = list(table.columns)
+    cells = []
+    for column in headings:
+        if column.startswith('Rolling'):
+            cells.append(table[column].map('{:,.1f}'.format).to_numpy(dtype=object))
+        else:
+            cells.append(table[column].astype('int64').map('{:,}'.format).to_numpy(dtype=object))
+    labels = table.index.strftime('%Y/%-m/%-d')
+    rows = [(label, list(values)) for label, values in zip(labels, zip(*cells))]
+    return headings, rows
+
+
+# キャッシュディレクトリを使って日付ごとの感染者数とステータスを返す
+#   CSV が更新されていない (304 Not Modified) 場合はダウンロードも CSV の読み込みも行わず、
+#   前回集計した結果をそのまま返す (集計した CSV とキャッシュの CSV のサイズが異なる場合は集計し直す)
+#   incremental が True の場合は前回集計した行より後に追加された行だけを集計する
+#   downloaded には既に download_patients_csv を呼び出している場合にその結果を渡す
+def get_cached_number_of_patients(url, cache_dir, incremental=False, chunksize=None, date_format=None,
+                                  downloaded=None):
+    csv_path = os.path.join(cache_dir, CACHE_CSV_FILENAME)
+    if downloaded is None:
+        downloaded = download_patients_csv(url, cache_dir)
+    store = load_count_store(cache_dir)
+    if not downloaded and store is not None:
+        # CSV を置き換えた後に集計結果を保存できなかった場合は、集計結果が CSV と一致しないので集計し直す
+        if store['csv_length'] == os.path.getsize(csv_path):
+            print(f'{url} : not modified')
+            return store['number_of_patients']
+        print(f'{url} : not modified, but the counts do not match the cached CSV')
+
+    if incremental and store is not None:
+        number_of_patients, csv_length, csv_sha256 = update_number_of_patients(csv_path, store,
+                                                                               chunksize, date_format)
+        if number_of_patients is not None:
+            save_count_store(cache_dir, number_of_patients, csv_length, csv_sha256)
+            return number_of_patients
+        print(f'{url} : previously counted rows are changed, count all rows')
+
+    number_of_patients = count_patients(csv_path, chunksize, date_format)
+    number_of_patients['Status'] = get_statuses(number_of_patients)
+    csv_length, csv_sha256 = hash_file(csv_path)
+    save_count_store(cache_dir, number_of_patients, csv_length, csv_sha256)
+    return number_of_patients
+
+
+# 前回集計した CSV の内容 (先頭からのバイト列) が変わっていなければ、その後に追加された行だけを集計して
+# 前回の集計結果に加える
+#   ステータスは件数が変わった日付とその翌週の同一曜日だけを再計算する
+#   前回集計した内容が変わっている場合は (None, None, None) を返す
+def update_number_of_patients(csv_path, store, chunksize=None, date_format=None):
+    hasher = hashlib.sha256()
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        f.seek(0)
+        remaining = store['csv_length']
+        while remaining > 0:
+            block = f.read(min(remaining, HASH_BLOCK_SIZE))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+        if remaining > 0 or hasher.hexdigest() != store['csv_sha256']:
+            return None, None, None
+
+        tail_length = 0
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+            tail_length += len(block)
+        csv_length = store['csv_length'] + tail_length
+
+        number_of_patients = store['number_of_patients']
+        if tail_length == 0:
+            return number_of_patients, csv_length, hasher.hexdigest()
+        print(f'{csv_path} : {tail_length:,} bytes appended')
+
+        # 追加された行だけを見出し行の列名で読み込む
+        names = pd.read_csv(io.BytesIO(header), encoding='shift-jis', encoding_errors='ignore', nrows=0).columns
+        f.seek(store['csv_length'])
+        new_patients = count_patients(f, chunksize, date_format, names=list(names))
+    if len(new_patients) == 0:
+        return number_of_patients, csv_length, hasher.hexdigest()
+
+    counts = number_of_patients['Count'].add(new_patients['Count'], fill_value=0).astype('int64')
+    statuses = number_of_patients['Status'].reindex(counts.index)
+    number_of_patients = pd.DataFrame({'Count': counts, 'Status': statuses})
+
+    # 件数が変わった日付と、その日付を前週とする日付のステータスを再計算する
+    affected_dates = new_patients.index.union(new_patients.index + timedelta(days=7)) \
+        .intersection(number_of_patients.index)
+    window = number_of_patients.loc[affected_dates.min() - timedelta(days=7):affected_dates.max()]
+    number_of_patients.loc[affected_dates, 'Status'] = get_statuses(window)[affected_dates]
+
+    return number_of_patients, csv_length, hasher.hexdigest()
+
+
+# ファイルのサイズと SHA-256 を返す
+def hash_file(path):
+    hasher = hashlib.sha256()
+    length = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+            length += len(block)
+    return length, hasher.hexdigest()
+
+
+# 前回の ETag / Last-Modified を使って条件付きで CSV をダウンロードし、キャッシュを更新する
+#   True  : CSV をダウンロードした
+#   False : CSV は更新されていない (304 Not Modified)
+def download_patients_csv(url, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    csv_path = os.path.join(cache_dir, CACHE_CSV_FILENAME)
+    meta_path = os.path.join(cache_dir, CACHE_META_FILENAME)
+
+    headers = {}
+    if os.path.exists(csv_path) and os.path.exists(meta_path):
+        with open(meta_path, 'rt') as f:
+            meta = json.load(f)
+        if meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True) as res:
+        if res.status_code == 304:
+            return False
+        res.raise_for_status()
+
+        with open(csv_path + '.tmp', 'wb') as f:
+            for block in res.iter_content(chunk_size=HASH_BLOCK_SIZE):
+                f.write(block)
+        os.replace(csv_path + '.tmp', csv_path)
+
+    meta = {
+        'url': url,
+        'etag': res.headers.get('ETag'),
+        'last_modified': res.headers.get('Last-Modified'),
+    }
+    with open(meta_path + '.tmp', 'wt') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    return True
+
+
+# キャッシュディレクトリに保存した集計結果を読み込む
+#   number_of_patients : 日付ごとの感染者数とステータス
+#   csv_length         : 集計済みの CSV のバイト数
+#   csv_sha256         : 集計済みの CSV の SHA-256
+#   保存されていない場合は None
+def load_count_store(cache_dir):
+    store_path = os.path.join(cache_dir, CACHE_COUNTS_FILENAME)
+    if not os.path.exists(store_path):
+        return None
+
+    with np.load(store_path) as store:
+        if 'csv_sha256' not in store.files:
+            return None
+        index = pd.DatetimeIndex(store['dates'].astype('datetime64[ns]'), name='Date')
+        number_of_patients = pd.DataFrame({'Count': store['counts'], 'Status': store['statuses']}, index=index)
+        number_of_patients['Status'] = number_of_patients['Status'].astype(object)
+        return {
+            'number_of_patients': number_of_patients,
+            'csv_length': int(store['csv_length']),
+            'csv_sha256': str(store['csv_sha256']),
+        }
+
+
+# 集計結果をキャッシュディレクトリに保存する
+def save_count_store(cache_dir, number_of_patients, csv_length, csv_sha256):
+    store_path = os.path.join(cache_dir, CACHE_COUNTS_FILENAME)
+    with open(store_path + '.tmp', 'wb') as f:
+        np.savez(f,
+                 dates=number_of_patients.index.values.astype('datetime64[D]'),
+                 counts=number_of_patients['Count'].to_numpy(dtype='int64'),
+                 statuses=number_of_patients['Status'].to_numpy(dtype=str),
+                 csv_length=csv_length,
+                 csv_sha256=csv_sha256)
+    os.replace(store_path + '.tmp', store_path)
+
 
 # 指定された日付毎のデータ件数 (感染者数) のステータスを返す
 #   'yellow' : 前週の同一曜日より少なくなっている
@@ -48,6 +665,19 @@ def get_status(row, number_of_patients):
         return 'red'
 
 
+# 日毎のデータ件数 (感染者数) のステータスを一括で返す
+#   日付の抜けを埋めた日毎のカレンダーに並べ直し、7 日ずらした件数と比較する
+#   get_status と同じく前週の同一曜日のデータが無い場合は 'red'
+def get_statuses(number_of_patients):
+    counts = number_of_patients['Count']
+    calendar = pd.date_range(counts.index.min(), counts.index.max(), freq='D')
+    last_week_counts = counts.reindex(calendar).shift(7).reindex(counts.index)
+
+    statuses = pd.Series('red', index=counts.index, name='Status')
+    statuses[counts <= last_week_counts] = 'yellow'
+    return statuses
+
+
 # 開始 / 終了日から週毎の日付のリストを返すジェネレータ
 def dates_of_weeks(start, stop):
     current = start
@@ -67,20 +697,71 @@ def dates_of_weeks(start, stop):
         current = current + step
 
 
-# 指定された日毎の感染者数データからレポート用の HTML を生成する
-def generate_html(number_of_patients, template_file):
+# カレンダーの日付毎のセルの表示内容を週毎のリストで返す
+#   セルは (日付の表示, 感染者数の表示, セルの class) のタプル
+#   感染者数のデータが無い日は感染者数の表示が '' 、ステータスが 'green' となる
+#   日付の表示は前のセルと年が変わる場合 (最初のセルを含む) だけ年を付ける
+def calendar_weeks(number_of_patients, start, stop):
+    first_date = start - timedelta(days=start.isoweekday() % 7)
+    last_date = stop + timedelta(days=6 - stop.isoweekday() % 7)
+    dates = pd.date_range(first_date, last_date, freq='D')
+
+    cases = number_of_patients.reindex(dates)
+    statuses = cases['Status'].fillna('green').to_numpy(dtype=object)
+    classes = np.array(DAYBOX_CLASSES, dtype=object)[dates.dayofweek] + ' ' + statuses + 'box'
+    counts = number_of_patients['Count'].map('{:,}'.format).reindex(dates, fill_value='').to_numpy(dtype=object)
+
+    years = dates.year.to_numpy()
+    year_changed = np.ones(len(dates), dtype=bool)
+    year_changed[1:] = years[1:] != years[:-1]
+    labels = np.where(year_changed, dates.strftime('%y/%-m/%-d'), dates.strftime('%-m/%-d'))
+
+    cells = list(zip(labels.tolist(), counts.tolist(), classes.tolist()))
+    return [tuple(cells[n:n + 7]) for n in range(0, len(cells), 7)]
+
+
+# テンプレートファイルをコンパイルして返す
+#   コンパイルしたテンプレートはファイルの更新日時が変わるまで使い回す
+def load_template(template_file):
+    return compile_template(template_file, os.stat(template_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template_file, mtime_ns):
     with open(template_file, 'rt') as f:
         html = f.read()
+    return Template(html)
 
-    template = Template(html)
+
+# 指定された日毎の感染者数データからレポート用の HTML を生成する
+#   aggregation が指定された場合は属性別の件数と移動平均もテンプレートに渡す
+def generate_html(number_of_patients, template_file, aggregation=None):
+    return load_template(template_file).render(template_data(number_of_patients, aggregation))
+
+
+# テンプレートに渡すデータ (カレンダーのセルなど) を返す
+def template_data(number_of_patients, aggregation=None):
+    start = number_of_patients.index.min()
+    stop = pd.to_datetime(date.today())
     data = {
-        'dates_of_weeks': dates_of_weeks(number_of_patients.index.min(), pd.to_datetime(date.today())),
+        'calendar_weeks': calendar_weeks(number_of_patients, start, stop),
+        'dates_of_weeks': dates_of_weeks(start, stop),
         'number_of_cases': number_of_patients,
-        'daybox_classes': ['daybox', 'daybox', 'daybox', 'daybox', 'daybox', 'daybox', 'daybox'],
+        'daybox_classes': DAYBOX_CLASSES,
         'generate_date': datetime.now().strftime('%Y/%-m/%-d %-H:%-M'),
         'initial_prev_date': datetime(1900, 1, 1),
     }
-    return template.render(data)
+    if aggregation is not None:
+        data['breakdowns'] = aggregation['breakdowns']
+        data['rolling_averages'] = aggregation['rolling_averages']
+        data['breakdown_headings'], data['breakdown_rows'] = breakdown_table(aggregation)
+    return data
+
+
+COMMANDS = {
+    'batch': batch_main,
+    'serve': serve_main,
+}
 
 
 if __name__ == "__main__":
@@ -1,16 +1,65 @@
 import argparse
+import csv
 import pathlib
 import os
+import re
+import sys
 import hashlib
+import json
+import tarfile
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO
 from openpyxl import load_workbook
 from jinja2 import Template
 
+# 出力ファイル名の書式の {項目名}
+FILENAME_PLACEHOLDER = re.compile(r'\{([^{}]*)\}')
+
+MANIFEST_FILENAME = '.excel_to_formatted_text.json'
+
+LINETERMINATORS = {'cr': '\r', 'lf': '\n', 'crlf': '\r\n'}
+
+# --jobs を指定した場合にワーカープロセスに 1 回で渡す行数
+BATCH_SIZE = 256
+
+# 入力ファイルの拡張子毎の形式
+INPUT_FORMATS = {
+    '.xlsx': 'xlsx', '.xlsm': 'xlsx', '.xltx': 'xlsx', '.xltm': 'xlsx',
+    '.csv': 'csv',
+    '.tsv': 'tsv', '.tab': 'tsv',
+    '.ods': 'ods',
+}
+
+# ODS (content.xml) の名前空間
+ODS_TABLE = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+ODS_OFFICE = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+ODS_TEXT = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+# --bundle のファイルの書き込みのバッファサイズ
+BUNDLE_BUFFER_SIZE = 1024 * 1024
+
+# ワーカープロセスのテンプレート (init_worker でプロセス毎に 1 回だけコンパイルする)
+worker_template = None
+
 
 def main():
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='Excel to formated text')
-    parser.add_argument('-x', '--excelfile', required=True, help='Excel filename')
-    parser.add_argument('-s', '--sheetname', required=True, help='Sheet name')
+    parser.add_argument('-x', '--excelfile', required=True, help='Excel filename (or CSV / TSV / ODS filename)')
+    parser.add_argument('-s', '--sheetname', required=False, help='Sheet name (not used for CSV / TSV)')
+    parser.add_argument('-if', '--input-format', choices=['xlsx', 'csv', 'tsv', 'ods'], required=False,
+                        help='Input file format (default: by the extension)')
+    parser.add_argument('-ie', '--input-encoding', default='utf-8-sig', required=False,
+                        help='Input CSV / TSV file encoding')
     parser.add_argument('-o', '--outputfile', required=True, help='Output filename format')
     parser.add_argument('-oe', '--outputfile-encoding', default='utf8', required=False, help='Output text file encoding')
     parser.add_argument('-lt', '--outputfile-lineterminator', choices=['cr', 'lf', 'crlf'],
@@ -21,10 +70,23 @@ def main():
     parser.add_argument('-c', '--startcol', default=1, type=int, required=False, help='Excel sheet start column no')
     parser.add_argument('-b', '--blank-skip-columns', required=False, type=str, action='append',
                         help='Skip if this column is blank')
+    parser.add_argument('-m', '--manifest', nargs='?', const=MANIFEST_FILENAME, required=False,
+                        help=f'Output hash manifest file to skip unchanged files without reading them '
+                             f'(default: {MANIFEST_FILENAME})')
+    parser.add_argument('-j', '--jobs', default=1, type=int, required=False,
+                        help='Number of processes to render and write text files')
+    parser.add_argument('--bundle', required=False,
+                        help='Write all outputs into one zip / tar (.tar, .tar.gz, .tgz) archive or concatenated file')
+    parser.add_argument('--record-separator', default='', required=False,
+                        help='Separator between outputs in a concatenated bundle file (backslash escapes allowed)')
 
     args = parser.parse_args()
+    input_format = args.input_format or input_format_of(args.excelfile)
+    if input_format in ('xlsx', 'ods') and not args.sheetname:
+        parser.error(f'--sheetname is required for {input_format} files')
 
     print(f'Excel file : {args.excelfile}')
+    print(f'Input format : {input_format}')
     print(f'Sheet name : {args.sheetname}')
     print(f'Output file format : {args.outputfile}')
     print(f'Output file encoding : {args.outputfile_encoding}')
@@ -34,49 +96,273 @@ def main():
     print(f'Start row : {args.startrow}')
     print(f'Start column : {args.startcol}')
     print(f'Blank skip column : {args.blank_skip_columns}')
+    print(f'Manifest file : {args.manifest}')
+    print(f'Jobs : {args.jobs}')
+    print(f'Bundle file : {args.bundle}')
+
+    lineterminator = LINETERMINATORS[args.outputfile_lineterminator]
+
+    manifest = load_manifest(args.manifest) if args.manifest else None
+    try:
+        with ExitStack() as stack:
+            bundle = None
+            if args.bundle:
+                bundle = stack.enter_context(
+                    Bundle(args.bundle, decode_escapes(args.record_separator).encode(args.outputfile_encoding)))
+            to_text(args.excelfile, args.sheetname, args.startrow, args.startcol, args.blank_skip_columns,
+                    args.outputfile, args.outputfile_encoding, lineterminator,
+                    args.templatefile, args.templatefile_encoding, manifest, args.jobs, bundle,
+                    input_format, args.input_encoding)
+    finally:
+        if manifest is not None:
+            save_manifest(args.manifest, manifest)
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='excel_to_formatted_text.py batch',
+                                     description='Excel to formated text (batch)')
+    parser.add_argument('jobfile', help='Job file (JSON or YAML list of sheetname, templatefile, outputfile)')
+    parser.add_argument('-x', '--excelfile', required=True, help='Excel filename (or CSV / TSV / ODS filename)')
+    parser.add_argument('-if', '--input-format', choices=['xlsx', 'csv', 'tsv', 'ods'], required=False,
+                        help='Input file format (default: by the extension)')
+    parser.add_argument('-ie', '--input-encoding', default='utf-8-sig', required=False,
+                        help='Input CSV / TSV file encoding')
+    parser.add_argument('-m', '--manifest', nargs='?', const=MANIFEST_FILENAME, required=False,
+                        help=f'Output hash manifest file to skip unchanged files without reading them '
+                             f'(default: {MANIFEST_FILENAME})')
+    args = parser.parse_args(argv)
+
+    outputs = load_jobfile(args.jobfile)
+    print(f'Excel file : {args.excelfile}')
+    print(f'Job file : {args.jobfile} ({len(outputs)} outputs)')
+    print(f'Manifest file : {args.manifest}')
+
+    manifest = load_manifest(args.manifest) if args.manifest else None
+    try:
+        with ExitStack() as stack:
+            for output in outputs:
+                if output['bundle']:
+                    separator = decode_escapes(output['record_separator']).encode(output['outputfile_encoding'])
+                    output['bundle'] = stack.enter_context(Bundle(output['bundle'], separator))
+            batch_to_text(args.excelfile, outputs, manifest, args.input_format, args.input_encoding)
+    finally:
+        if manifest is not None:
+            save_manifest(args.manifest, manifest)
+
+
+# ジョブファイルを読み込み、省略された項目を既定値で補った出力のリストを返す
+def load_jobfile(jobfile):
+    with open(jobfile, 'rt', encoding='utf8') as f:
+        if os.path.splitext(jobfile)[1].lower() in ('.yml', '.yaml'):
+            import yaml
+            outputs = yaml.safe_load(f)
+        else:
+            outputs = json.load(f)
+
+    for n, output in enumerate(outputs):
+        for key in ('templatefile', 'outputfile'):
+            if key not in output:
+                raise ValueError(f'{jobfile} : "{key}" is missing in output #{n + 1}')
+        if output.get('outputfile_lineterminator', 'lf') not in LINETERMINATORS:
+            raise ValueError(f'{jobfile} : invalid outputfile_lineterminator in output #{n + 1}')
+        for key, default in JOBFILE_DEFAULTS.items():
+            output.setdefault(key, default)
+    return outputs
+
+
+JOBFILE_DEFAULTS = {
+    'sheetname': None,
+    'outputfile_encoding': 'utf8',
+    'outputfile_lineterminator': 'lf',
+    'templatefile_encoding': 'utf8',
+    'startrow': 1,
+    'startcol': 1,
+    'blank_skip_columns': None,
+    'bundle': None,
+    'record_separator': '',
+}
+
+
+# Excel ファイルを 1 回だけ開き、シート毎に行を 1 回だけ読み込んで、そのシートの全ての出力を行う
+#   同じシートでも startrow, startcol が異なる出力は別に読み込む
+#   出力の bundle には Bundle (または None) を指定する
+def batch_to_text(excelfile, outputs, manifest=None, input_format=None, input_encoding='utf-8-sig'):
+    with open_reader(excelfile, input_format, input_encoding) as reader:
+        batch_to_text_from(reader, outputs, manifest)
+
+
+def batch_to_text_from(reader, outputs, manifest):
+    sheets = {}
+    for output in outputs:
+        sheets.setdefault((output['sheetname'], output['startrow'], output['startcol']), []).append(output)
+
+    for (sheetname, startrow, startcol), sheet_outputs in sheets.items():
+        print(f'Sheet name : {sheetname} ({len(sheet_outputs)} outputs)')
+        rows = reader.rows(sheetname, startrow, startcol)
+        col_names = read_col_names(rows)
 
-    lineterminator = '\n'
-    if args.outputfile_lineterminator == 'cr':
-        lineterminator = '\r'
-    elif args.outputfile_lineterminator == 'crlf':
-        lineterminator = '\r\n'
+        targets = []
+        for output in sheet_outputs:
+            with open(output['templatefile'], 'rt', encoding=output['templatefile_encoding']) as f:
+                template = Template(f.read(), newline_sequence=LINETERMINATORS[output['outputfile_lineterminator']],
+                                    keep_trailing_newline=True)
+            bundle = output['bundle']
+            output_filename = compile_output_filename(output['outputfile'], col_names, make_dirs=bundle is None)
+            targets.append((output['blank_skip_columns'], output_filename, template, output['outputfile_encoding'],
+                            bundle))
 
-    to_text(args.excelfile, args.sheetname, args.startrow, args.startcol, args.blank_skip_columns,
-            args.outputfile, args.outputfile_encoding, lineterminator,
-            args.templatefile, args.templatefile_encoding)
+        for row in rows:
+            cell_values = to_dictionary(row, col_names)
+            for blank_skip_columns, output_filename, template, outputfile_encoding, bundle in targets:
+                if not is_outputtable_row(cell_values, blank_skip_columns):
+                    continue
+                filename = output_filename(cell_values)
+                if bundle is not None:
+                    bundle.add(filename, template.render(cell_values).encode(outputfile_encoding))
+                    print(f'{filename} is added.')
+                    continue
+                print_output(filename, output_text(template, cell_values, filename, outputfile_encoding, manifest))
 
 
 def to_text(excelfile, sheetname, startrow, startcol, blank_skip_columns,
             filename_format, outputfile_encoding, lineterminator,
-            templatefile, templatefile_encoding):
-    wb = load_workbook(filename=excelfile, read_only=True)
-    ws = wb[sheetname]
+            templatefile, templatefile_encoding, manifest=None, jobs=1, bundle=None,
+            input_format=None, input_encoding='utf-8-sig'):
+    with open_reader(excelfile, input_format, input_encoding) as reader:
+        rows = reader.rows(sheetname, startrow, startcol)
+        to_text_from(rows, blank_skip_columns, filename_format, outputfile_encoding, lineterminator,
+                     templatefile, templatefile_encoding, manifest, jobs, bundle)
 
-    col_names = []
-    for col in range(startcol, ws.max_column+1):
-        col_names.append((col-1, ws.cell(startrow, col).value))
-        print(ws.cell(startrow, col).value)
+
+# 見出し行から始まる行 (startcol 列目以降のセルの値のタプル) をテキストファイルに出力する
+def to_text_from(rows, blank_skip_columns, filename_format, outputfile_encoding, lineterminator,
+                 templatefile, templatefile_encoding, manifest=None, jobs=1, bundle=None):
+    col_names = read_col_names(rows)
+    # bundle が指定された場合は出力ファイル名をメンバー名として使う (ディレクトリは作成しない)
+    output_filename = compile_output_filename(filename_format, col_names, make_dirs=bundle is None)
 
     with open(templatefile, 'rt', encoding=templatefile_encoding) as f:
         template_text = f.read()
-    template = Template(template_text, newline_sequence=lineterminator, keep_trailing_newline=True)
 
-    for row in ws.iter_rows(min_row=startrow+1):
-        cell_values = to_dictionary(row, col_names)
-        if not is_outputtable_row(cell_values, blank_skip_columns):
+    def output_rows():
+        for row in rows:
+            cell_values = to_dictionary(row, col_names)
+            if not is_outputtable_row(cell_values, blank_skip_columns):
+                continue
+
+            filename = output_filename(cell_values)
+#            print(filename)
+            yield cell_values, filename
+
+    if jobs > 1:
+        to_text_parallel(output_rows(), template_text, outputfile_encoding, lineterminator, manifest, jobs, bundle)
+        return
+
+    template = Template(template_text, newline_sequence=lineterminator, keep_trailing_newline=True)
+    for cell_values, filename in output_rows():
+        if bundle is not None:
+            bundle.add(filename, template.render(cell_values).encode(outputfile_encoding))
+            print(f'{filename} is added.')
             continue
+        print_output(filename, output_text(template, cell_values, filename, outputfile_encoding, manifest))
 
-        filename = generate_output_filename(cell_values, filename_format)
-#        print(filename)
 
-        text = template.render(cell_values)
+# 行の読み込みと出力ファイル名の生成はメインプロセスで行い、BATCH_SIZE 行毎にプロセスプールでテンプレートの出力と書き込みを行う
+#   結果は行の順に出力する
+#   同じ出力ファイル名が処理中のバッチにある場合は、書き込みの順序が逆転しないように処理中のバッチの完了を待つ
+#   bundle が指定された場合はワーカープロセスではテンプレートの出力だけを行い、メインプロセスで行の順に bundle に書き込む
+def to_text_parallel(rows, template_text, outputfile_encoding, lineterminator, manifest, jobs, bundle=None):
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(template_text, lineterminator)) as executor:
+        pending = deque()
+        pending_filenames = set()
 
-        if is_modified(text, filename):
-            print(f'{filename} is modified.')
-            with open(filename, 'wt', newline='', encoding=outputfile_encoding) as f:
-                f.write(text)
-        else:
-            print(f'{filename} is not modified.')
+        def collect():
+            future, filenames = pending.popleft()
+            if bundle is not None:
+                for filename, data in future.result():
+                    bundle.add(filename, data)
+                    print(f'{filename} is added.')
+                return
+            results, batch_manifest = future.result()
+            pending_filenames.difference_update(filenames)
+            if manifest is not None:
+                manifest.update(batch_manifest)
+            for filename, modified in results:
+                print_output(filename, modified)
+
+        def submit(batch):
+            if bundle is not None:
+                pending.append((executor.submit(render_batch, batch, outputfile_encoding), None))
+                while len(pending) > jobs * 2:
+                    collect()
+                return
+            filenames = set(filename for cell_values, filename in batch)
+            batch_manifest = None
+            if manifest is not None:
+                batch_manifest = {str(filename): manifest[str(filename)]
+                                  for filename in filenames if str(filename) in manifest}
+            future = executor.submit(output_batch, batch, outputfile_encoding, batch_manifest)
+            pending.append((future, filenames))
+            pending_filenames.update(filenames)
+            while len(pending) > jobs * 2:
+                collect()
+
+        batch = []
+        for cell_values, filename in rows:
+            if filename in pending_filenames:
+                while pending:
+                    collect()
+            batch.append((cell_values, filename))
+            if len(batch) >= BATCH_SIZE:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        while pending:
+            collect()
+
+
+def init_worker(template_text, lineterminator):
+    global worker_template
+    worker_template = Template(template_text, newline_sequence=lineterminator, keep_trailing_newline=True)
+
+
+# ワーカープロセスでバッチの行を出力し、([(出力ファイル名, 変更されたかどうか)], 更新したマニフェスト) を返す
+def output_batch(batch, outputfile_encoding, manifest):
+    results = [(filename, output_text(worker_template, cell_values, filename, outputfile_encoding, manifest))
+               for cell_values, filename in batch]
+    return results, manifest
+
+
+# ワーカープロセスでバッチの行をテンプレートで出力し、[(出力ファイル名, エンコードした内容)] を返す
+def render_batch(batch, outputfile_encoding):
+    return [(filename, worker_template.render(cell_values).encode(outputfile_encoding))
+            for cell_values, filename in batch]
+
+
+# 行データをテンプレートで出力ファイルに書き込み、変更されたかどうかを返す (変更されていない場合は書き込まない)
+def output_text(template, cell_values, filename, outputfile_encoding, manifest=None):
+    data = template.render(cell_values).encode(outputfile_encoding)
+    if not is_modified(data, filename, manifest):
+        return False
+    write_output(data, filename, manifest)
+    return True
+
+
+def print_output(filename, modified):
+    if modified:
+        print(f'{filename} is modified.')
+    else:
+        print(f'{filename} is not modified.')
+
+
+# 見出し行 (最初の行) の startcol 列目以降のセルの値を項目名とする
+def read_col_names(rows):
+    col_names = next(rows, ())
+    for col_name in col_names:
+        print(col_name)
+    return col_names
 
 
 def is_outputtable_row(cell_values, blank_skip_columns):
@@ -89,44 +375,337 @@ def is_outputtable_row(cell_values, blank_skip_columns):
     return True
 
 
-def generate_output_filename(cell_values, filename_format):
-    output_filename = filename_format
-    for col_name in cell_values:
-        output_filename = output_filename.replace('{' + col_name + '}', cell_values[col_name])
+# 出力ファイル名の書式を、行データから出力ファイル名 (絶対パス) を返す関数に変換する
+#   書式は {項目名} の位置で分割しておき、項目名に無い {...} はそのまま残す
+#   ディレクトリは作成済みのものを覚えておき、作成と絶対パスへの変換はディレクトリ毎に 1 回だけ行う
+#   make_dirs でない場合は書式に従った出力ファイル名 (文字列) をそのまま返す
+def compile_output_filename(filename_format, col_names, make_dirs=True):
+    col_names = set(col_name for col_name in col_names if isinstance(col_name, str))
+    parts = []
+    pos = 0
+    for m in FILENAME_PLACEHOLDER.finditer(filename_format):
+        if m.group(1) in col_names:
+            parts.append((filename_format[pos:m.start()], m.group(1)))
+            pos = m.end()
+    tail = filename_format[pos:]
 
-    output_filename = pathlib.Path(output_filename).resolve()
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    resolved_dirs = {}
 
-    return pathlib.Path(output_filename).resolve()
+    def output_filename(cell_values):
+        filename = ''.join([literal + cell_values[col_name] for literal, col_name in parts]) + tail
+        if not make_dirs:
+            return filename
+        dirname, basename = os.path.split(filename)
+        resolved_dir = resolved_dirs.get(dirname)
+        if resolved_dir is None:
+            resolved_dir = pathlib.Path(dirname).resolve()
+            os.makedirs(resolved_dir, exist_ok=True)
+            resolved_dirs[dirname] = resolved_dir
+        return resolved_dir / basename
 
+    return output_filename
 
-def to_dictionary(row, col_names):
-    dict = {}
-    for col_no, col_name in col_names:
-        if not row[col_no].value is None:
-            dict[col_name] = str(row[col_no].value)
-        else:
-            dict[col_name] = ''
 
-    return dict
+# 行のセルの値 (startcol 列目以降) を項目名をキーとする辞書に変換する (None は '')
+def to_dictionary(row, col_names):
+    return {col_name: '' if value is None else str(value) for col_name, value in zip(col_names, row)}
 
 
-def is_modified(new_text, filename):
-    if not os.path.exists(filename):
+# 出力ファイルの内容 (出力ファイルのエンコーディングでエンコードしたもの) が変わるかどうかを返す
+#   サイズが異なる場合はファイルを読まない
+#   manifest に記録したサイズ・更新日時が変わっておらず、SHA-256 が同じ場合もファイルを読まない
+def is_modified(new_data, filename, manifest=None):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
         return True
+    if st.st_size != len(new_data):
+        return True
+
+    if manifest is not None:
+        entry = [st.st_size, st.st_mtime_ns, hashlib.sha256(new_data).hexdigest()]
+        if manifest.get(str(filename)) == entry:
+            return False
 
     with open(filename, 'rb') as file:
-        file_text = file.read()
-        file_text_hs = hashlib.sha256(file_text).hexdigest()
+        if file.read() != new_data:
+            return True
+    if manifest is not None:
+        manifest[str(filename)] = entry
+    return False
+
+
+def write_output(data, filename, manifest=None):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    if manifest is not None:
+        st = os.stat(filename)
+        manifest[str(filename)] = [st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest()]
+
+
+# 出力ファイル毎の [サイズ, 更新日時 (ns), SHA-256] を記録したマニフェストを読み込む (無い場合は空)
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def input_format_of(filename):
+    return INPUT_FORMATS.get(os.path.splitext(filename)[1].lower(), 'xlsx')
+
+
+# 入力ファイルの形式 (省略した場合は拡張子で判定する) のリーダーを返す
+#   リーダーの rows(sheetname, startrow, startcol) は startrow 行目 (見出し行) からの行の startcol 列目以降のセルの値のタプルを返す
+def open_reader(filename, input_format=None, encoding='utf-8-sig'):
+    input_format = input_format or input_format_of(filename)
+    if input_format == 'csv':
+        return CsvReader(filename, encoding)
+    elif input_format == 'tsv':
+        return CsvReader(filename, encoding, delimiter='\t')
+    elif input_format == 'ods':
+        return OdsReader(filename)
+    return XlsxReader(filename)
+
+
+# 見出し行より短い行を None で補う (CSV, ODS は行毎に列数が異なるため)
+def pad_rows(rows):
+    width = None
+    for row in rows:
+        if width is None:
+            width = len(row)
+        elif len(row) < width:
+            row = row + (None,) * (width - len(row))
+        yield row
+
+
+class XlsxReader:
+    """
+    openpyxl (読み取り専用モード) で Excel ファイルを読み込むリーダー
+    """
+    def __init__(self, filename):
+        self.wb = load_workbook(filename=filename, read_only=True)
+
+    def rows(self, sheetname, startrow=1, startcol=1):
+        ws = self.wb[sheetname]
+        rows = ws.iter_rows(min_row=startrow, min_col=startcol, max_col=ws.max_column, values_only=True)
+        if ws.max_column is None:
+            # 範囲 (dimension) が記録されていないシート (openpyxl の write_only モードで作成したものなど) は行毎に列数が異なる
+            return pad_rows(rows)
+        return rows
+
+    def close(self):
+        self.wb.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvReader:
+    """
+    CSV / TSV ファイルを 1 行ずつ読み込むリーダー (sheetname は使わない、セルの値は全て文字列)
+    """
+    def __init__(self, filename, encoding='utf-8-sig', delimiter=','):
+        self.filename = filename
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+    def rows(self, sheetname=None, startrow=1, startcol=1):
+        with open(self.filename, 'rt', newline='', encoding=self.encoding) as f:
+            records = csv.reader(f, delimiter=self.delimiter)
+            yield from pad_rows(tuple(record[startcol-1:]) for n, record in enumerate(records, start=1)
+                                if n >= startrow)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OdsReader:
+    """
+    ODS ファイルの content.xml を iterparse で 1 行ずつ読み込むリーダー
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def rows(self, sheetname, startrow=1, startcol=1):
+        return pad_rows(row[startcol-1:] for n, row in enumerate(self.sheet_rows(sheetname), start=1)
+                        if n >= startrow)
+
+    # シートの行を返す
+    #   行・列の繰り返し (number-rows-repeated, number-columns-repeated) を展開し、末尾の空のセル・空の行は返さない
+    #   読み終えた要素は (対象外のシートの要素も) 親要素から取り除き、content.xml 全体をメモリに保持しない
+    #   (行の中の要素 (セルなど) は行を読み終えるまで残す)
+    def sheet_rows(self, sheetname):
+        with zipfile.ZipFile(self.filename) as zf, zf.open('content.xml') as f:
+            in_sheet = False
+            empty_rows = 0
+            parents = []
+            open_rows = 0
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(elem)
+                    if elem.tag == ODS_TABLE + 'table' and not open_rows:
+                        in_sheet = elem.get(ODS_TABLE + 'name') == sheetname
+                    elif elem.tag == ODS_TABLE + 'table-row':
+                        open_rows += 1
+                    continue
+
+                parents.pop()
+                if elem.tag == ODS_TABLE + 'table-row':
+                    open_rows -= 1
+                if open_rows:
+                    continue
+                if elem.tag == ODS_TABLE + 'table' and in_sheet:
+                    return
+
+                values = []
+                repeat = 0
+                if in_sheet and elem.tag == ODS_TABLE + 'table-row':
+                    values = ods_row_values(elem)
+                    repeat = int(elem.get(ODS_TABLE + 'number-rows-repeated', 1))
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+                if not repeat:
+                    continue
+
+                if not values:
+                    empty_rows += repeat
+                    continue
+                for n in range(empty_rows):
+                    yield ()
+                empty_rows = 0
+                for n in range(repeat):
+                    yield tuple(values)
+        raise KeyError(f'Worksheet {sheetname} does not exist.')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ODS の行のセルの値のリスト (列の繰り返しを展開し、末尾の空のセルは含めない)
+#   空のセルは数だけを数えておき、後に空でないセルがある場合だけ None を追加する
+#   (LibreOffice は行末に約 1000 列の空のセルの繰り返しを書き出すため)
+def ods_row_values(row):
+    values = []
+    empty_cells = 0
+    for cell in row:
+        repeat = int(cell.get(ODS_TABLE + 'number-columns-repeated', 1))
+        value = ods_cell_value(cell)
+        if value is None:
+            empty_cells += repeat
+            continue
+        if empty_cells:
+            values.extend([None] * empty_cells)
+            empty_cells = 0
+        values.extend([value] * repeat)
+    return values
+
+
+# ODS のセルの値 (空のセルは None、整数の数値は int)
+def ods_cell_value(cell):
+    value_type = cell.get(ODS_OFFICE + 'value-type')
+    if value_type is None:
+        return None
+    if value_type in ('float', 'percentage', 'currency'):
+        value = float(cell.get(ODS_OFFICE + 'value'))
+        return int(value) if value.is_integer() else value
+    if value_type == 'date':
+        return cell.get(ODS_OFFICE + 'date-value')
+    if value_type == 'time':
+        return cell.get(ODS_OFFICE + 'time-value')
+    if value_type == 'boolean':
+        return cell.get(ODS_OFFICE + 'boolean-value') == 'true'
+    return '\n'.join(''.join(p.itertext()) for p in cell.iter(ODS_TEXT + 'p'))
+
+
+# バックスラッシュのエスケープ (\\n, \\t, \\x0c など) を解釈する
+def decode_escapes(text):
+    return text.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+
+
+class Bundle:
+    """
+    全ての出力を 1 つのファイルに順に書き出す出力先
+
+    拡張子が .zip の場合は zip, .tar / .tar.gz / .tgz の場合は tar のアーカイブに出力ファイル名をメンバー名として格納し、
+    それ以外の場合は record_separator で区切って連結する
+    """
+    def __init__(self, path, record_separator=b''):
+        self.path = path
+        self.record_separator = record_separator
+        self.mtime = time.time()
+        self.count = 0
+        self.zip = None
+        self.tar = None
+        self.file = open(path, 'wb', buffering=BUNDLE_BUFFER_SIZE)
+        name = path.lower()
+        if name.endswith('.zip'):
+            self.zip = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_DEFLATED)
+        elif name.endswith(('.tar.gz', '.tgz')):
+            self.tar = tarfile.open(fileobj=self.file, mode='w|gz')
+        elif name.endswith('.tar'):
+            self.tar = tarfile.open(fileobj=self.file, mode='w|')
+
+    def add(self, name, data):
+        """
+        出力を追加する
+        """
+        name = name.replace(os.sep, '/')
+        if self.zip is not None:
+            info = zipfile.ZipInfo(name, date_time=time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.zip.writestr(info, data)
+        elif self.tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(self.mtime)
+            self.tar.addfile(info, BytesIO(data))
+        else:
+            if self.count:
+                self.file.write(self.record_separator)
+            self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        if self.tar is not None:
+            self.tar.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-    # ファイルのエンコードが UTF-8 と仮定、new_text は UTF-8 のはず
-    new_text_hs = hashlib.sha256(new_text.encode()).hexdigest()
-    if new_text_hs == file_text_hs:
-        return False
 
-    # ファイルのエンコードが SJIS と仮定、new_text は UTF-8 のはずなので sjis に変換
-    new_text_hs = hashlib.sha256(new_text.encode('sjis')).hexdigest()
-    return not (new_text_hs == file_text_hs)
+COMMANDS = {
+    'batch': batch_main,
+}
 
 
 if __name__ == "__main__":
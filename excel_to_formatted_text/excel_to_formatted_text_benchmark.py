@@ -0,0 +1,175 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+from jinja2 import Template
+
+import excel_to_formatted_text
+
+SURNAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤']
+GIVEN_NAMES = ['太郎', '花子', '一郎', '美咲', '健太', '陽子', '翔太', '由美', '大輔', '真由美']
+PREFECTURES = ['福岡県', '佐賀県', '長崎県', '熊本県', '大分県', '宮崎県', '鹿児島県']
+CITIES = ['北九州市小倉北区', '福岡市博多区', '久留米市', '佐世保市', '熊本市中央区', '大分市', '宮崎市']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of excel_to_formatted_text')
+    parser.add_argument('-r', '--rows', default=10000, type=int, help='Number of rows of the synthetic workbook')
+    parser.add_argument('-c', '--cols', default=10, type=int, help='Number of columns of the synthetic workbook')
+    parser.add_argument('-oe', '--outputfile-encoding', default='sjis', help='Output text file encoding')
+    parser.add_argument('-j', '--jobs', type=int, action='append',
+                        help='Number of processes of the end-to-end run (default: 1)')
+    parser.add_argument('-w', '--workdir', required=False,
+                        help='Directory of the synthetic workbook and the output files (workbook reused if exists)')
+
+    args = parser.parse_args()
+    if args.cols < 5:
+        parser.error('--cols must be 5 or more')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='excel-to-formatted-text-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    excelfile = os.path.join(workdir, f'benchmark-{args.rows}-{args.cols}.xlsx')
+    if not os.path.exists(excelfile):
+        print(f'Generating {excelfile} ...')
+        generate_workbook(excelfile, args.rows, args.cols)
+    templatefile = os.path.join(workdir, 'benchmark_template.txt')
+    with open(templatefile, 'wt', encoding='utf8') as f:
+        f.write(generate_template(args.cols))
+
+    output_dir = os.path.join(workdir, 'output')
+    filename_format = os.path.join(output_dir, '{都道府県}', '{ID}_{氏名}.txt')
+
+    print(f'{"stage":<16} {"run":<5} {"sec":>10} {"rows/sec":>14} {"peak RSS MiB":>14}')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    for run in ('cold', 'warm'):
+        stages = Stages(excelfile, filename_format, templatefile, args.outputfile_encoding)
+        for name in Stages.STAGES:
+            elapsed = measure(getattr(stages, name))
+            print_result(name, run, elapsed, args.rows)
+        stages = None
+
+    for jobs in sorted(set(args.jobs or [1])):
+        for run in ('cold', 'warm'):
+            if run == 'cold':
+                shutil.rmtree(output_dir, ignore_errors=True)
+            elapsed = measure(lambda: run_to_text(excelfile, filename_format, templatefile,
+                                                  args.outputfile_encoding, jobs))
+            print_result(f'to_text (j={jobs})', run, elapsed, args.rows)
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+class Stages:
+    """
+    to_text の処理を段階毎に分けたもの
+    各段階は前の段階の結果を使う (行データなどは全ての行をメモリに保持する)
+    """
+    STAGES = ['load', 'iter_rows', 'to_dictionary', 'filename', 'render', 'is_modified', 'write']
+
+    def __init__(self, excelfile, filename_format, templatefile, outputfile_encoding):
+        self.excelfile = excelfile
+        self.filename_format = filename_format
+        self.templatefile = templatefile
+        self.outputfile_encoding = outputfile_encoding
+
+    def load(self):
+        self.reader = excel_to_formatted_text.XlsxReader(self.excelfile)
+
+    def iter_rows(self):
+        rows = self.reader.rows('data')
+        self.col_names = next(rows)
+        self.rows = list(rows)
+        self.reader.close()
+
+    def to_dictionary(self):
+        self.cell_values = [excel_to_formatted_text.to_dictionary(row, self.col_names) for row in self.rows]
+        self.rows = None
+
+    def filename(self):
+        output_filename = excel_to_formatted_text.compile_output_filename(self.filename_format, self.col_names)
+        self.filenames = [output_filename(cell_values) for cell_values in self.cell_values]
+
+    def render(self):
+        with open(self.templatefile, 'rt', encoding='utf8') as f:
+            template = Template(f.read(), keep_trailing_newline=True)
+        self.data = [template.render(cell_values).encode(self.outputfile_encoding)
+                     for cell_values in self.cell_values]
+        self.cell_values = None
+
+    def is_modified(self):
+        self.modified = [excel_to_formatted_text.is_modified(data, filename)
+                         for data, filename in zip(self.data, self.filenames)]
+
+    def write(self):
+        for data, filename, modified in zip(self.data, self.filenames, self.modified):
+            if modified:
+                excel_to_formatted_text.write_output(data, filename)
+
+
+def run_to_text(excelfile, filename_format, templatefile, outputfile_encoding, jobs):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        excel_to_formatted_text.to_text(excelfile, 'data', 1, 1, None, filename_format, outputfile_encoding, '\n',
+                                        templatefile, 'utf8', jobs=jobs)
+
+
+# 処理時間 (秒) を返す
+def measure(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+# プロセスのピークの RSS (MiB) を返す (resource モジュールが無い環境では None)
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def print_result(name, run, elapsed, rows):
+    rss = peak_rss()
+    rss = f'{rss:,.1f}' if rss is not None else '-'
+    print(f'{name:<16} {run:<5} {elapsed:>10.3f} {rows / elapsed:>14,.0f} {rss:>14}')
+
+
+# ID, 氏名, 都道府県, 住所, 年齢 の後に 備考N の列が続く (5 列未満は指定できない)
+def generate_col_names(cols):
+    return ['ID', '氏名', '都道府県', '住所', '年齢'] + [f'備考{n}' for n in range(1, cols - 4)]
+
+
+# 全ての列を「項目名 : {{ 項目名 }}」の形式で出力するテンプレート
+def generate_template(cols):
+    return ''.join(f'{col_name} : {{{{ {col_name} }}}}\n' for col_name in generate_col_names(cols))
+
+
+# 日本語の文字列を含む rows 行 x cols 列のワークブックを生成する (シート名は data、1 行目は見出し行)
+def generate_workbook(excelfile, rows, cols, seed=0):
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    col_names = generate_col_names(cols)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('data')
+    ws.append(col_names)
+    for n in range(rows):
+        values = [n + 1,
+                  rng.choice(SURNAMES) + rng.choice(GIVEN_NAMES),
+                  rng.choice(PREFECTURES),
+                  f'{rng.choice(CITIES)}{rng.randint(1, 9)}丁目{rng.randint(1, 30)}-{rng.randint(1, 20)}',
+                  rng.randint(0, 99)]
+        for col in range(5, len(col_names)):
+            values.append(None if rng.random() < 0.1 else f'備考の文章です。{n}-{col} ' + 'あいうえお' * rng.randint(0, 5))
+        ws.append(values)
+    wb.save(excelfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,41 @@
 import argparse
 from io import BytesIO
+import hashlib
+import json
 import os
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import repeat
+
+# APIC フレームの MIME タイプ毎の、そのまま書き出せるアートワークファイルの拡張子
+PASSTHROUGH_EXTENSIONS = {
+    'image/jpeg': ('.jpg', '.jpeg'),
+    'image/jpg': ('.jpg', '.jpeg'),
+    'image/png': ('.png',),
+    'image/gif': ('.gif',),
+    'image/bmp': ('.bmp',),
+    'image/webp': ('.webp',),
+}
+
+# m4a のアートワークの atom のパス (meta atom は先頭 4 バイトが version / flags)
+MP4_COVR_PATH = (b'moov', b'udta', b'meta', b'ilst', b'covr', b'data')
+
+MANIFEST_FILENAME = '.export_artworks.sqlite3'
+
+# inotify のイベント (<sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
 
 
 def main():
@@ -8,67 +43,863 @@ def main():
     parser.add_argument('-d', '--music-dir', required=True, help='Music file directory')
     parser.add_argument('-f', '--artwork-filename', default='Folder.jpg', required=False, help='Artrwork file name')
     parser.add_argument('-F', '--force-export', action='store_true', help='Overwrite existing artwork files')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of parallel artwork exports')
+    parser.add_argument('--reencode', action='store_true',
+                        help='Always decode and re-encode mp3 artworks even if the format matches')
+    parser.add_argument('--header-only', action='store_true',
+                        help='Read only the ID3v2 tag / covr atom instead of parsing the whole file')
+    parser.add_argument('-m', '--manifest', nargs='?', const='', required=False,
+                        help=f'Scan manifest file to skip unchanged directories (default: MUSIC_DIR/{MANIFEST_FILENAME})')
+    parser.add_argument('-s', '--artwork-store', required=False,
+                        help='Directory to store each unique artwork once and hardlink it into album directories')
+    parser.add_argument('-v', '--variant', dest='variants', action='append', type=parse_variant, default=[],
+                        metavar='SIZE[:FORMAT]',
+                        help='Generate a resized variant of each artwork (e.g. 300, 100:webp)')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep watching the music file directory and export artworks of added albums (Linux only)')
+    parser.add_argument('--debounce', default=2.0, type=float,
+                        help='Seconds to wait after the last change of an album directory in watch mode')
+    parser.add_argument('--progress', action='store_true', help='Show a live progress line on stderr')
+    parser.add_argument('--report', required=False, help='Write the statistics of the run to a JSON file')
+    parser.add_argument('--profile', nargs='?', const='', required=False,
+                        help='Run under cProfile and print the statistics (or dump them to the file)')
 
     args = parser.parse_args()
 
     print(f'Music file directory : {args.music_dir}')
     print(f'Music Artrwork file name : {args.artwork_filename}')
 
-    export(args.music_dir, args.artwork_filename, args.force_export)
+    print(f'Jobs : {args.jobs}')
+    if args.variants:
+        print('Variants : ' + ', '.join(f'{size}{ext}' for size, ext in args.variants))
 
+    manifest = None
+    if args.manifest is not None:
+        manifest = ScanManifest(args.manifest or os.path.join(args.music_dir, MANIFEST_FILENAME))
+        print(f'Manifest file : {manifest.path}')
 
-def export(dir, artwork_filename, force_export):
-    print(f'export at {dir}')
-    exported = False
-    for f in os.listdir(dir):
-        file_path = os.path.join(dir, f)
-        if os.path.isdir(file_path):
-            export(file_path, artwork_filename, force_export)
+    stats = ExportStats(args.progress)
+    if args.watch:
+        run = watch
+        run_args = (args.music_dir, args.artwork_filename, args.force_export, args.jobs, args.debounce, manifest)
+        run_kwargs = dict(reencode=args.reencode, header_only=args.header_only, store_dir=args.artwork_store,
+                          variants=args.variants, stats=stats)
+    else:
+        run = export
+        run_args = (args.music_dir, args.artwork_filename, args.force_export, args.jobs, args.reencode,
+                    args.header_only, manifest, args.artwork_store, args.variants)
+        run_kwargs = dict(stats=stats)
+
+    try:
+        if args.profile is not None:
+            profile(run, run_args, run_kwargs, args.profile)
         else:
-            if exported:
+            run(*run_args, **run_kwargs)
+    finally:
+        if manifest:
+            manifest.close()
+        stats.finish()
+        print(stats.format_summary())
+        if args.report:
+            report = stats.to_dict()
+            report.update(music_dir=args.music_dir, jobs=args.jobs)
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f'Report file : {args.report}')
+
+
+# cProfile で実行し、統計情報を出力する (filename が指定された場合はファイルに保存する)
+#   プロファイルされるのはメインスレッドだけ (--jobs のワーカーは対象外)
+def profile(func, args, kwargs, filename=''):
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(func, *args, **kwargs)
+    finally:
+        if filename:
+            profiler.dump_stats(filename)
+            print(f'Profile file : {filename}')
+        else:
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+
+
+# アートワークをエクスポートする
+#   音楽ファイル毎のエラーは stats に記録して次の音楽ファイルに進む (マニフェストには記録しない)
+def export(dir, artwork_filename, force_export, jobs=1, reencode=False, header_only=False, manifest=None,
+           store_dir=None, variants=None, recursive=True, stats=None):
+    stats = stats or ExportStats()
+    # バリアントを生成するアートワークファイルのパス (既に存在するアートワークファイルを含む)
+    artworks = [] if variants else None
+    targets = scan(dir, artwork_filename, force_export, manifest, artworks, recursive, stats)
+    if jobs <= 1:
+        for file_path, artwork_filepath in targets:
+            try:
+                sha256 = export_artwork(file_path, artwork_filepath, reencode=reencode, header_only=header_only,
+                                        store_dir=store_dir, stats=stats)
+            except Exception as e:
+                stats.error(file_path, e)
                 continue
+            if manifest:
+                manifest.set_artwork(os.path.dirname(artwork_filepath), file_path, sha256)
+            if sha256 and variants:
+                artworks.append(artwork_filepath)
+        if manifest:
+            manifest.commit()
+        if variants:
+            resize(artworks, variants, jobs, stats)
+        return
 
-            artwork_filepath = os.path.join(os.path.dirname(file_path), artwork_filename)
-            if (not force_export) \
-                    and os.path.exists(artwork_filepath):
-                print(f'{artwork_filepath} : already exists')
-                exported = True
+    # 未完了のエクスポートが jobs * 2 件を超えないように、完了を待ちながら投入する
+    # 画像の形式の変換はプロセスプールで行う
+    with ThreadPoolExecutor(max_workers=jobs) as executor, \
+            ProcessPoolExecutor(max_workers=jobs) as converter:
+        pending = {}
+        for file_path, artwork_filepath in targets:
+            if len(pending) >= jobs * 2:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    exported(future, pending.pop(future), manifest, artworks, stats)
+            future = executor.submit(export_artwork, file_path, artwork_filepath,
+                                     reencode=reencode, converter=converter, header_only=header_only,
+                                     store_dir=store_dir, stats=stats)
+            pending[future] = (file_path, artwork_filepath)
+        for future in list(pending):
+            exported(future, pending.pop(future), manifest, artworks, stats)
+    if manifest:
+        manifest.commit()
+    if variants:
+        resize(artworks, variants, jobs, stats)
+
+
+# 完了したエクスポートの結果をマニフェストに記録する (エクスポートで発生した例外は stats に記録する)
+def exported(future, target, manifest, artworks=None, stats=None):
+    file_path, artwork_filepath = target
+    try:
+        sha256 = future.result()
+    except Exception as e:
+        stats.error(file_path, e)
+        return
+    if manifest:
+        manifest.set_artwork(os.path.dirname(artwork_filepath), file_path, sha256)
+    if sha256 and artworks is not None:
+        artworks.append(artwork_filepath)
+
+
+# ディレクトリを再帰的に走査し、ディレクトリ毎にアートワークをエクスポートする
+# (音楽ファイルのパス, アートワークファイルのパス) を返すジェネレータ
+#   ディレクトリ内で最初に見つかった mp3, m4a ファイルが対象
+#   アートワークファイルが既に存在する場合は (force_export でなければ) 対象外
+#   manifest が指定された場合は前回から更新されていないディレクトリを列挙せず、
+#   force_export でもエクスポート元の音楽ファイルが更新されていなければ対象外
+#   existing が指定された場合は既に存在する (エクスポートしない) アートワークファイルのパスを追加する
+#   recursive でない場合は dir だけを対象とする
+def scan(dir, artwork_filename, force_export, manifest=None, existing=None, recursive=True, stats=None):
+    stats = stats or ExportStats()
+    dirs = [dir]
+    while dirs:
+        current = dirs.pop()
+        artwork_filepath = os.path.join(current, artwork_filename)
+        if manifest:
+            try:
+                mtime_ns = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            known_subdirs = manifest.get_unchanged_subdirs(current, mtime_ns)
+            if known_subdirs is not None:
+                stats.count('dirs_skipped')
+                source = manifest.get_changed_source(current) if force_export else None
+                if source:
+                    print(f'{source} : modified')
+                    yield (source, artwork_filepath)
+                elif existing is not None and os.path.exists(artwork_filepath):
+                    # 変更されていないディレクトリのアートワークファイルもバリアントの生成の対象にする
+                    existing.append(artwork_filepath)
+                dirs.extend(reversed(known_subdirs))
                 continue
 
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext == '.mp3':
-                export_mp3_artwork(file_path, artwork_filepath)
-                exported = True
-            elif ext == '.m4a':
-                export_mp4_artwork(file_path, artwork_filepath)
-                exported = True
+        print(f'export at {current}')
+        subdirs = []
+        target = None
+        exported = False
+        artwork_exists = None
+        with stats.timer('walk'), os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                    continue
+                if exported:
+                    continue
 
+                if artwork_exists is None:
+                    artwork_exists = (not force_export) and os.path.exists(artwork_filepath)
+                if artwork_exists:
+                    print(f'{artwork_filepath} : already exists')
+                    stats.count('artworks_existing')
+                    if existing is not None:
+                        existing.append(artwork_filepath)
+                    exported = True
+                    continue
+
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in ('.mp3', '.m4a'):
+                    target = (entry.path, artwork_filepath)
+                    exported = True
+        stats.count('dirs_scanned')
+
+        if manifest:
+            if target and force_export and manifest.is_unchanged_source(current, target[0]) \
+                    and os.path.exists(artwork_filepath):
+                print(f'{target[0]} : not modified')
+                stats.count('artworks_existing')
+                if existing is not None:
+                    existing.append(artwork_filepath)
+                target = None
+            manifest.set_directory(current, mtime_ns, subdirs, pending=target is not None)
+
+        if target:
+            yield target
+        # サブディレクトリは列挙された順に走査する
+        if recursive:
+            dirs.extend(reversed(subdirs))
+
+
+# 最初に全体をエクスポートした後、inotify でディレクトリの作成と mp3, m4a ファイルの追加を監視し、
+# 追加されたアルバムのディレクトリのアートワークをエクスポートする
+#   ディレクトリ毎に最後の変更から debounce 秒経過してから、スレッドプール (jobs 並列) でエクスポートする
+#   manifest は最初のエクスポートだけで使う
+def watch(dir, artwork_filename, force_export, jobs=1, debounce=2.0, manifest=None, stats=None, **options):
+    stats = stats or ExportStats()
+    inotify = Inotify()
+    try:
+        # 監視を開始してから最初のエクスポートを行う (その間に追加されたファイルも取りこぼさない)
+        watch_tree(inotify, dir)
+        export(dir, artwork_filename, force_export, jobs, manifest=manifest, stats=stats, **options)
+        print(f'watching {dir}')
+
+        deadlines = {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while True:
+                now = time.monotonic()
+                for album_dir in [d for d, deadline in deadlines.items() if deadline <= now]:
+                    del deadlines[album_dir]
+                    future = executor.submit(export, album_dir, artwork_filename, False, recursive=False,
+                                             stats=stats, **options)
+                    future.add_done_callback(lambda f, album_dir=album_dir: report_error(f, album_dir, stats))
+
+                timeout = max(min(deadlines.values()) - now, 0) if deadlines else None
+                for path, mask in inotify.read_events(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        # イベントを取りこぼしたので全体を監視・走査し直す
+                        print(f'{dir} : inotify queue overflow')
+                        for album_dir in watch_tree(inotify, dir):
+                            deadlines[album_dir] = time.monotonic() + debounce
+                    elif mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            for album_dir in watch_tree(inotify, path):
+                                deadlines[album_dir] = time.monotonic() + debounce
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        if os.path.splitext(path)[1].lower() in ('.mp3', '.m4a'):
+                            deadlines[os.path.dirname(path)] = time.monotonic() + debounce
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+
+
+# ディレクトリとそのサブディレクトリを監視対象に追加し、mp3, m4a ファイルを含むディレクトリのリストを返す
+def watch_tree(inotify, dir):
+    album_dirs = []
+    dirs = [dir]
+    while dirs:
+        current = dirs.pop()
+        try:
+            inotify.add_watch(current, WATCH_MASK)
+            with os.scandir(current) as entries:
+                has_music = False
+                for entry in entries:
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in ('.mp3', '.m4a'):
+                        has_music = True
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if has_music:
+            album_dirs.append(current)
+    return album_dirs
 
-def export_mp3_artwork(file_path, artwork_filepath):
-    import mutagen.mp3
-    from PIL import Image
 
-    id3 = mutagen.mp3.MP3(file_path)
-    artwork = id3.get("APIC:")
+def report_error(future, dir, stats):
+    exception = future.exception()
+    if exception:
+        stats.error(dir, exception)
+
+
+# アートワークをエクスポートし、書き出したアートワークの SHA-256 を返す (アートワークが無い場合は None)
+def export_artwork(file_path, artwork_filepath, reencode=False, converter=None, header_only=False, store_dir=None,
+                   stats=None):
+    stats = stats or ExportStats()
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.mp3':
+        return export_mp3_artwork(file_path, artwork_filepath, reencode, converter, header_only, store_dir, stats)
+    elif ext == '.m4a':
+        return export_mp4_artwork(file_path, artwork_filepath, header_only, store_dir, stats)
+
+
+# APIC フレームの画像の形式がアートワークファイルの拡張子と一致する場合はそのまま書き出す
+# 一致しない場合 (または reencode の場合) は PIL で変換する (converter が指定された場合はそのプロセスプールで)
+# header_only の場合は ID3v2 タグの領域だけを読み込む
+def export_mp3_artwork(file_path, artwork_filepath, reencode=False, converter=None, header_only=False,
+                       store_dir=None, stats=None):
+    stats = stats or ExportStats()
+    with stats.timer('parse'):
+        if header_only:
+            artwork, bytes_read = read_id3_artwork(file_path)
+        else:
+            import mutagen.mp3
+
+            id3 = mutagen.mp3.MP3(file_path)
+            artwork = id3.get("APIC:")
+            bytes_read = None
+    count_inspected(stats, file_path, bytes_read)
     if artwork:
-        print(f'{file_path} : exists artwork')
-        img = Image.open(BytesIO(artwork.data))
-        img.save(artwork_filepath)
+        print(f'{file_path} : exists artwork{format_bytes_read(bytes_read)}')
+        if not reencode and is_passthrough(artwork.mime, artwork_filepath):
+            data = artwork.data
+        else:
+            with stats.timer('convert'):
+                if converter:
+                    data = converter.submit(convert_artwork, artwork.data, artwork_filepath).result()
+                else:
+                    data = convert_artwork(artwork.data, artwork_filepath)
+        return write_artwork(data, artwork_filepath, store_dir, stats)
     else:
-        print(f'{file_path} : not exists artwork')
+        print(f'{file_path} : not exists artwork{format_bytes_read(bytes_read)}')
+        stats.count('artworks_missing')
+        return None
+
 
+def is_passthrough(mime, artwork_filepath):
+    ext = os.path.splitext(artwork_filepath)[1].lower()
+    return ext in PASSTHROUGH_EXTENSIONS.get(mime.lower(), ())
 
-def export_mp4_artwork(file_path, artwork_filepath):
-    import mutagen.mp4
 
-    mp4 = mutagen.mp4.MP4(file_path)
-    artwork = mp4.get("covr")
+# 画像をアートワークファイルの拡張子の形式に変換したバイト列を返す
+def convert_artwork(data, artwork_filepath):
+    from PIL import Image
+
+    img = Image.open(BytesIO(data))
+    ext = os.path.splitext(artwork_filepath)[1].lower()
+    buf = BytesIO()
+    img.save(buf, format=Image.registered_extensions()[ext])
+    return buf.getvalue()
+
+
+# header_only の場合は moov/udta/meta/ilst/covr atom までシークしてアートワークだけを読み込む
+def export_mp4_artwork(file_path, artwork_filepath, header_only=False, store_dir=None, stats=None):
+    stats = stats or ExportStats()
+    with stats.timer('parse'):
+        if header_only:
+            artwork, bytes_read = read_mp4_artwork(file_path)
+        else:
+            import mutagen.mp4
+
+            mp4 = mutagen.mp4.MP4(file_path)
+            covr = mp4.get("covr")
+            artwork = covr[0] if covr else None
+            bytes_read = None
+    count_inspected(stats, file_path, bytes_read)
     if artwork:
-        print(f'{file_path} : exists artwork')
-        with open(artwork_filepath, mode='wb') as f:
-            f.write(artwork[0])
+        print(f'{file_path} : exists artwork{format_bytes_read(bytes_read)}')
+        return write_artwork(artwork, artwork_filepath, store_dir, stats)
     else:
-        print(f'{file_path} : not exists artwork')
+        print(f'{file_path} : not exists artwork{format_bytes_read(bytes_read)}')
+        stats.count('artworks_missing')
+        return None
+
+
+# 読み込んだ音楽ファイルを数える (ファイル全体を解析した場合の読み込みバイト数はファイルサイズとする)
+def count_inspected(stats, file_path, bytes_read):
+    if bytes_read is None:
+        bytes_read = os.path.getsize(file_path)
+    stats.count('files_inspected')
+    stats.count('bytes_read', bytes_read)
+
+
+# バリアントの指定 (SIZE[:FORMAT]) を (サイズ, 拡張子) に変換する (FORMAT を省略した場合はアートワークファイルと同じ形式)
+def parse_variant(spec):
+    size, _, fmt = spec.partition(':')
+    if not size.isdigit() or int(size) <= 0:
+        raise argparse.ArgumentTypeError(f'invalid variant size: {spec}')
+    ext = '.' + fmt.lower().lstrip('.') if fmt else ''
+    return int(size), ext
+
+
+# バリアントのファイル名 (例: Folder.jpg の 300px の WebP は Folder-300.webp)
+def variant_filepath(artwork_filepath, size, ext=''):
+    stem, artwork_ext = os.path.splitext(artwork_filepath)
+    return f'{stem}-{size}{ext or artwork_ext}'
+
+
+# アートワークファイルのバリアントを生成する (jobs が 2 以上の場合はプロセスプールで)
+#   アートワークファイル毎のエラーは stats に記録して次のアートワークファイルに進む
+def resize(artwork_filepaths, variants, jobs=1, stats=None):
+    stats = stats or ExportStats()
+    with stats.timer('resize'):
+        if jobs <= 1:
+            generated(map(try_generate_variants, artwork_filepaths, repeat(variants)), stats)
+            return
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            generated(executor.map(try_generate_variants, artwork_filepaths, repeat(variants), chunksize=16), stats)
+
+
+# 生成したバリアントを出力する (バリアントの生成で発生した例外は stats に記録する)
+def generated(results, stats):
+    for artwork_filepath, filepaths, exception in results:
+        if exception is not None:
+            stats.error(artwork_filepath, exception)
+            continue
+        for filepath in filepaths:
+            print(f'{filepath} : generated')
+            stats.count('variants_generated')
+
+
+# バリアントを生成し、(アートワークファイルのパス, 生成したファイルのパスのリスト, 例外 (成功した場合は None)) を返す
+#   (例外で map 全体が止まらないようにする)
+def try_generate_variants(artwork_filepath, variants):
+    try:
+        return artwork_filepath, generate_variants(artwork_filepath, variants), None
+    except Exception as e:
+        return artwork_filepath, [], e
+
+
+# アートワークファイルより古い (または存在しない) バリアントを生成し、生成したファイルのパスのリストを返す
+#   アートワークファイルの新しさは ctime で比較する
+#   (--artwork-store でハードリンクに置き換えたアートワークファイルの mtime はアートワークストアのファイルの古い日時のままだが、
+#   ctime はハードリンクの作成と置き換えで更新される)
+#   画像のデコードは 1 回だけ行い、JPEG は draft で最大のバリアントのサイズ以上の縮小率でデコードする
+#   大きいバリアントから順に、1 つ前のバリアントの画像を縮小して生成する
+def generate_variants(artwork_filepath, variants):
+    from PIL import Image
+
+    ctime_ns = os.stat(artwork_filepath).st_ctime_ns
+    outdated = []
+    for size, ext in variants:
+        filepath = variant_filepath(artwork_filepath, size, ext)
+        try:
+            if os.stat(filepath).st_mtime_ns >= ctime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        outdated.append((size, filepath))
+    if not outdated:
+        return []
+
+    outdated.sort(key=lambda variant: variant[0], reverse=True)
+    extensions = Image.registered_extensions()
+    with Image.open(artwork_filepath) as img:
+        img.draft('RGB', (outdated[0][0], outdated[0][0]))
+        img.load()
+        current = img
+        for size, filepath in outdated:
+            current = current.copy()
+            current.thumbnail((size, size), reducing_gap=2.0)
+            fmt = extensions[os.path.splitext(filepath)[1].lower()]
+            output = current
+            if fmt == 'JPEG' and output.mode not in ('RGB', 'L'):
+                output = output.convert('RGB')
+            tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+            output.save(tmp_filepath, format=fmt)
+            os.replace(tmp_filepath, filepath)
+    return [filepath for size, filepath in outdated]
+
+
+# アートワークを書き出し、その SHA-256 を返す
+#   既存のアートワークファイルと内容が同じ場合は書き出さない
+#   store_dir が指定された場合は内容毎に 1 つだけ store_dir に保存し、アートワークファイルはそのハードリンクにする
+def write_artwork(data, artwork_filepath, store_dir=None, stats=None):
+    stats = stats or ExportStats()
+    with stats.timer('write'):
+        result = store_artwork(data, artwork_filepath, store_dir)
+    stats.count(f'artworks_{result}')
+    if result == 'written':
+        stats.count('bytes_written', len(data))
+    return hashlib.sha256(data).hexdigest()
+
+
+# アートワークを書き出し、'written' (書き出した), 'linked' (ハードリンクにした), 'unchanged' (同じ内容) のいずれかを返す
+def store_artwork(data, artwork_filepath, store_dir=None):
+    sha256 = hashlib.sha256(data).hexdigest()
+    if store_dir is None:
+        if is_same_content(artwork_filepath, data, sha256):
+            print(f'{artwork_filepath} : not modified')
+            return 'unchanged'
+        replace_file(artwork_filepath, data)
+        return 'written'
+
+    ext = os.path.splitext(artwork_filepath)[1].lower()
+    stored_filepath = os.path.join(store_dir, sha256[:2], sha256 + ext)
+    if not os.path.exists(stored_filepath):
+        os.makedirs(os.path.dirname(stored_filepath), exist_ok=True)
+        replace_file(stored_filepath, data)
+
+    if os.path.exists(artwork_filepath) and os.path.samefile(stored_filepath, artwork_filepath):
+        print(f'{artwork_filepath} : not modified')
+        return 'unchanged'
+
+    # 既存のアートワークファイルはハードリンクで置き換える (別のファイルシステムの場合は書き出す)
+    tmp_filepath = f'{artwork_filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(stored_filepath, tmp_filepath)
+    except OSError:
+        if is_same_content(artwork_filepath, data, sha256):
+            print(f'{artwork_filepath} : not modified')
+            return 'unchanged'
+        replace_file(artwork_filepath, data)
+        return 'written'
+    os.replace(tmp_filepath, artwork_filepath)
+    print(f'{artwork_filepath} : linked to {stored_filepath}')
+    return 'linked'
+
+
+# 一時ファイルに書き出してから置き換える
+#   既存のファイルがアートワークストアのハードリンクの場合でも、リンク先 (共有している内容) は書き換えない
+def replace_file(filepath, data):
+    tmp_filepath = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_filepath, mode='wb') as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+
+# ファイルの内容が data と同じかどうかを返す (サイズが異なる場合はファイルを読まない)
+def is_same_content(filepath, data, sha256):
+    try:
+        if os.path.getsize(filepath) != len(data):
+            return False
+    except FileNotFoundError:
+        return False
+    with open(filepath, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest() == sha256
+
+
+# ファイル先頭の ID3v2 タグの領域だけを読み込んで APIC フレームを返す
+#   (APIC フレーム (無い場合は None), 読み込んだバイト数)
+def read_id3_artwork(file_path):
+    from mutagen.id3 import ID3
+
+    with open(file_path, 'rb') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            return None, len(header)
+
+        # タグのサイズは 7 bit x 4 の syncsafe integer (ヘッダとフッタを含まない)
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        if header[5] & 0x10:
+            size += 10
+        body = f.read(size)
+
+    id3 = ID3(BytesIO(header + body), load_v1=False)
+    return id3.get("APIC:"), len(header) + len(body)
+
+
+# m4a ファイルの atom のヘッダだけを辿って covr atom の最初の画像を返す
+#   (画像のバイト列 (無い場合は None), 読み込んだバイト数)
+def read_mp4_artwork(file_path):
+    with open(file_path, 'rb') as f:
+        start = 0
+        end = os.fstat(f.fileno()).st_size
+        bytes_read = 0
+        for name in MP4_COVR_PATH:
+            found = False
+            offset = start
+            while offset + 8 <= end:
+                f.seek(offset)
+                header = f.read(8)
+                bytes_read += len(header)
+                if len(header) < 8:
+                    break
+                size, atom_name = struct.unpack('>I4s', header)
+                data_offset = offset + 8
+                if size == 1:
+                    extended = f.read(8)
+                    bytes_read += len(extended)
+                    size = struct.unpack('>Q', extended)[0]
+                    data_offset += 8
+                elif size == 0:
+                    size = end - offset
+                if size < data_offset - offset:
+                    break
+                if atom_name == name:
+                    start, end = data_offset, offset + size
+                    found = True
+                    break
+                offset += size
+            if not found:
+                return None, bytes_read
+            if name == b'meta':
+                start += 4
+
+        # data atom は type (4 バイト) と locale (4 バイト) の後に画像が続く
+        f.seek(start + 8)
+        artwork = f.read(end - start - 8)
+        bytes_read += len(artwork)
+    return artwork, bytes_read
+
+
+def format_bytes_read(bytes_read):
+    if bytes_read is None:
+        return ''
+    return f' ({bytes_read:,} bytes read)'
+
+
+class ExportStats:
+    """
+    エクスポートの段階毎の処理時間と件数、エラーの種類毎の件数を集計する (スレッドセーフ)
+
+    段階毎の処理時間はスレッド毎の処理時間の合計 (--jobs を指定した場合は経過時間を超えることがある)
+    progress の場合は stderr に進捗を 1 行で表示する
+    """
+    PHASES = ('walk', 'parse', 'convert', 'write', 'resize')
+    COUNTERS = ('dirs_scanned', 'dirs_skipped', 'files_inspected', 'bytes_read',
+                'artworks_written', 'artworks_linked', 'artworks_unchanged', 'artworks_existing', 'artworks_missing',
+                'bytes_written', 'variants_generated')
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, progress=False):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.errors = {}
+        self.progress = progress
+        self.last_progress = 0.0
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        with ブロックの処理時間を段階の処理時間に加算する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.times[phase] += elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+        if self.progress:
+            self.show_progress()
+
+    def error(self, path, exception):
+        """
+        エラーを種類 (例外のクラス名) 毎に数える
+        """
+        name = type(exception).__name__
+        print(f'{path} : {name}: {exception}')
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        if self.progress:
+            self.show_progress()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def show_progress(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        counts = self.counts
+        skipped = counts['artworks_unchanged'] + counts['artworks_existing']
+        sys.stderr.write(f'\r{self.elapsed():8.1f}s dirs {counts["dirs_scanned"]:,} files {counts["files_inspected"]:,} '
+                         f'read {counts["bytes_read"] / 1024 / 1024:,.1f} MiB '
+                         f'written {counts["artworks_written"] + counts["artworks_linked"]:,} skipped {skipped:,} '
+                         f'errors {sum(self.errors.values()):,}')
+        sys.stderr.flush()
+
+    def finish(self):
+        """
+        進捗の表示を終える
+        """
+        if self.progress:
+            self.show_progress(force=True)
+            sys.stderr.write('\n')
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'elapsed': self.elapsed(),
+                'phases': dict(self.times),
+                'counts': dict(self.counts),
+                'errors': dict(self.errors),
+            }
+
+    def format_summary(self):
+        stats = self.to_dict()
+        lines = [f'Elapsed : {stats["elapsed"]:.3f} sec']
+        lines += [f'  {phase:<8} : {elapsed:.3f} sec' for phase, elapsed in stats['phases'].items()]
+        lines += [f'{name} : {count:,}' for name, count in stats['counts'].items()]
+        lines += [f'errors.{name} : {count:,}' for name, count in stats['errors'].items()]
+        return '\n'.join(lines)
+
+
+class Inotify:
+    """
+    ctypes で libc の inotify を呼び出す最小限のラッパー (Linux のみ)
+    """
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        """
+        ディレクトリを監視対象に追加する
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+
+    def read_events(self, timeout=None):
+        """
+        timeout 秒までイベントを待ち、(パス, マスク) のリストを返す
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            dir = self.paths.get(wd)
+            if dir is not None:
+                events.append((os.path.join(dir, os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ScanManifest:
+    """
+    前回の実行で走査したディレクトリとエクスポートしたアートワークを記録する SQLite のマニフェスト
+
+    directories : ディレクトリの更新日時とサブディレクトリ名
+    artworks    : ディレクトリ毎のエクスポート元の音楽ファイルのパス・サイズ・更新日時とアートワークの SHA-256
+    """
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS directories ('
+                          'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, subdirs TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS artworks ('
+                          'directory TEXT PRIMARY KEY, source_path TEXT NOT NULL, source_size INTEGER NOT NULL, '
+                          'source_mtime_ns INTEGER NOT NULL, artwork_sha256 TEXT)')
+        self.pending_directories = {}
+        self.changes = 0
+
+    def get_unchanged_subdirs(self, dir, mtime_ns):
+        """
+        ディレクトリが前回から更新されていなければ、記録しているサブディレクトリのパスのリストを返す
+        更新されている (または記録していない) 場合は None
+        """
+        row = self.conn.execute('SELECT mtime_ns, subdirs FROM directories WHERE path = ?', (dir,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            return None
+        return [os.path.join(dir, name) for name in json.loads(row[1])]
+
+    def get_changed_source(self, dir):
+        """
+        ディレクトリのエクスポート元の音楽ファイルが前回から更新されていれば、そのパスを返す
+        """
+        row = self.conn.execute('SELECT source_path, source_size, source_mtime_ns FROM artworks WHERE directory = ?',
+                                (dir,)).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(row[0])
+        except FileNotFoundError:
+            return None
+        if (st.st_size, st.st_mtime_ns) == (row[1], row[2]):
+            return None
+        return row[0]
+
+    def is_unchanged_source(self, dir, source_path):
+        """
+        ディレクトリのエクスポート元が前回と同じ音楽ファイルで、更新されていないかどうかを返す
+        """
+        row = self.conn.execute('SELECT source_path FROM artworks WHERE directory = ?', (dir,)).fetchone()
+        return row is not None and row[0] == source_path and self.get_changed_source(dir) is None
+
+    def set_directory(self, dir, mtime_ns, subdirs, pending=False):
+        """
+        ディレクトリを記録する
+        pending の場合はアートワークのエクスポートが完了するまで (set_artwork まで) 記録を保留する
+        """
+        names = json.dumps([os.path.basename(subdir) for subdir in subdirs], ensure_ascii=False)
+        if pending:
+            self.pending_directories[dir] = (mtime_ns, names)
+            return
+        self.__execute('INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs) VALUES (?, ?, ?)',
+                       (dir, mtime_ns, names))
+
+    def set_artwork(self, dir, source_path, artwork_sha256):
+        """
+        ディレクトリのエクスポート元の音楽ファイルとアートワークの SHA-256 を記録する
+        """
+        st = os.stat(source_path)
+        self.__execute('INSERT OR REPLACE INTO artworks '
+                       '(directory, source_path, source_size, source_mtime_ns, artwork_sha256) VALUES (?, ?, ?, ?, ?)',
+                       (dir, source_path, st.st_size, st.st_mtime_ns, artwork_sha256))
+        if dir in self.pending_directories:
+            mtime_ns, names = self.pending_directories.pop(dir)
+            self.__execute('INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs) VALUES (?, ?, ?)',
+                           (dir, mtime_ns, names))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __execute(self, sql, params):
+        self.conn.execute(sql, params)
+        self.changes += 1
+        if self.changes % self.COMMIT_INTERVAL == 0:
+            self.conn.commit()
 
 
 if __name__ == "__main__":
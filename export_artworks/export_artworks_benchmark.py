@@ -0,0 +1,105 @@
+import argparse
+from io import BytesIO
+import os
+import shutil
+import struct
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import export_artworks
+
+# MPEG-1 Layer III 128kbps 44.1kHz のフレーム (無音)
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of exporting music file artworks')
+    parser.add_argument('-a', '--albums', default=1000, type=int, help='Number of albums of the synthetic library')
+    parser.add_argument('-t', '--tracks', default=10, type=int, help='Number of tracks per album')
+    parser.add_argument('-s', '--artwork-size', default=1000, type=int, help='Width and height of the artworks')
+    parser.add_argument('-m', '--m4a-rate', default=0.0, type=float, help='Rate of albums in m4a')
+    parser.add_argument('-j', '--jobs', type=int, action='append', help='Number of parallel exports (default: 1)')
+    parser.add_argument('-d', '--music-dir', required=False,
+                        help='Directory of the synthetic library (reused if exists)')
+
+    args = parser.parse_args()
+
+    music_dir = args.music_dir or tempfile.mkdtemp(prefix='export-artworks-benchmark-')
+    if not os.path.exists(os.path.join(music_dir, 'artist0000')):
+        print(f'Generating {args.albums} albums at {music_dir} ...')
+        generate_library(music_dir, args.albums, args.tracks, args.artwork_size, args.m4a_rate)
+
+    print(f'{"mode":<12} {"jobs":>4} {"sec":>10} {"albums/sec":>12}')
+    for jobs in sorted(set(args.jobs or [1])):
+        for mode, options in BENCHMARK_MODES.items():
+            elapsed = run_export(music_dir, jobs, options)
+            print(f'{mode:<12} {jobs:>4} {elapsed:>10.3f} {args.albums / elapsed:>12,.1f}')
+
+    if not args.music_dir:
+        shutil.rmtree(music_dir)
+
+
+BENCHMARK_MODES = {
+    'reencode': {'reencode': True},
+    'passthrough': {'reencode': False},
+    'header-only': {'reencode': False, 'header_only': True},
+}
+
+
+# アートワークを強制的にエクスポートし、処理時間を返す
+def run_export(music_dir, jobs, options):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        export_artworks.export(music_dir, 'Folder.jpg', True, jobs, **options)
+    return time.perf_counter() - start
+
+
+# アートワーク (JPEG) 付きの mp3 / m4a ファイルのライブラリを生成する
+#   music_dir/artistNNNN/albumNNNNNN/NN.mp3
+def generate_library(music_dir, albums, tracks, artwork_size, m4a_rate):
+    from PIL import Image
+
+    m4a_albums = int(albums * m4a_rate)
+    for n in range(albums):
+        album_dir = os.path.join(music_dir, f'artist{n % 100:04d}', f'album{n:06d}')
+        os.makedirs(album_dir, exist_ok=True)
+
+        img = Image.new('RGB', (artwork_size, artwork_size), ((n * 37) % 256, (n * 91) % 256, 128))
+        buf = BytesIO()
+        img.save(buf, 'JPEG', quality=90)
+        artwork = buf.getvalue()
+
+        for track in range(tracks):
+            if n < m4a_albums:
+                generate_m4a(os.path.join(album_dir, f'{track:02d}.m4a'), artwork)
+            else:
+                generate_mp3(os.path.join(album_dir, f'{track:02d}.mp3'), artwork)
+
+
+def generate_mp3(file_path, artwork, frames=2000):
+    from mutagen.id3 import ID3, APIC
+
+    with open(file_path, 'wb') as f:
+        f.write(MP3_FRAME * frames)
+    id3 = ID3()
+    id3.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=artwork))
+    id3.save(file_path)
+
+
+def generate_m4a(file_path, artwork, mdat_size=800000):
+    def atom(name, payload):
+        return struct.pack('>I', 8 + len(payload)) + name + payload
+
+    covr = atom(b'covr', atom(b'data', struct.pack('>II', 13, 0) + artwork))
+    hdlr = atom(b'hdlr', b'\x00' * 8 + b'mdirappl' + b'\x00' * 9)
+    meta = atom(b'meta', b'\x00' * 4 + hdlr + atom(b'ilst', covr))
+    mvhd = atom(b'mvhd', b'\x00' * 4 + struct.pack('>IIII', 0, 0, 44100, 0) + b'\x00' * 80)
+    with open(file_path, 'wb') as f:
+        f.write(atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom'))
+        f.write(atom(b'mdat', b'\x00' * mdat_size))
+        f.write(atom(b'moov', mvhd + atom(b'udta', meta)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 import os
+import time
 import requests
 import json
 import mimetypes
 import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# リトライする HTTP ステータス
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 
 class GrowiClient:
@@ -10,7 +16,8 @@ class GrowiClient:
     GROWI クライアント
     """
     def __init__(self, growihost, port, apitoken, username, ssl=False,
-                 draft=False):
+                 draft=False, pool_size=10, timeout=(10, 60), retries=3,
+                 backoff_factor=0.5):
         """
         Parameters
         ----------
@@ -26,7 +33,29 @@ class GrowiClient:
         draft : bool
             true  ドラフト
             false 公開
-        """
+        pool_size : int
+            コネクションプールのサイズ
+        timeout : float or tuple
+            タイムアウト (秒)
+            (接続のタイムアウト, 読み込みのタイムアウト) のタプルも指定できる
+        retries : int
+            429, 5xx のレスポンス・接続エラー・読み込みのエラーの場合のリトライ回数
+            (POST は 429 のレスポンス・接続エラーの場合だけリトライする)
+        backoff_factor : float
+            リトライの間隔 (backoff_factor * 2 ** (リトライ回数 - 1) 秒)
+        """
+        self.session = requests.Session()
+        retry = GrowiRetry(total=retries, backoff_factor=backoff_factor,
+                           status_forcelist=RETRY_STATUSES,
+                           allowed_methods=frozenset(['GET', 'POST']),
+                           raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+        self.latencies = {}
+
         self.base_url = 'http{}://{}'.format('s' if ssl else '', growihost)
         if port:
             self.base_url += ':{}'.format(port)
@@ -95,8 +124,10 @@ class GrowiClient:
         if attachment_info:
             self.__remove_attachment(page, attachment_info)
         mime_type = mimetypes.guess_type(file_name)[0]
-        file = {'file': (file_name, open(file_path, 'rb'), mime_type)}
         payload = {"page_id": page.id, "path": page.path}
+        with open(file_path, 'rb') as f:
+            # リトライでも送り直せるように内容を読み込んでおく
+            file = {'file': (file_name, f.read(), mime_type)}
         res = self.__post('attachments.add', payload, file)
 
         page.add_attachment_info(res['attachment']['id'],
@@ -133,6 +164,43 @@ class GrowiClient:
         """
         return self.draft
 
+    def get_latency_stats(self):
+        """
+        GROWI API 毎のリクエストの所要時間 (リトライを含む) の統計を返す
+
+        Retruns
+        -------
+        stats : dict
+            GROWI API をキーとする以下の値の dict
+            count   : リクエスト数
+            retries : リトライ回数の合計
+            total   : 所要時間の合計 (秒)
+            mean    : 平均 (秒)
+            min     : 最小 (秒)
+            p50     : 中央値 (秒)
+            p95     : 95 パーセンタイル (秒)
+            max     : 最大 (秒)
+        """
+        stats = {}
+        for verb, (latencies, retries) in self.latencies.items():
+            latencies = sorted(latencies)
+            count = len(latencies)
+            stats[verb] = {"count": count,
+                           "retries": retries,
+                           "total": sum(latencies),
+                           "mean": sum(latencies) / count,
+                           "min": latencies[0],
+                           "p50": latencies[(count - 1) // 2],
+                           "p95": latencies[int((count - 1) * 0.95)],
+                           "max": latencies[-1]}
+        return stats
+
+    def close(self):
+        """
+        コネクションプールを閉じる
+        """
+        self.session.close()
+
     def __initialize_attachments_info(self, page):
         """
         指定された GROWI ページ情報の添付ファイル情報を初期化する
@@ -187,8 +255,8 @@ class GrowiClient:
             リクエストのレスポンス
         """
         url = self.base_url + '/{}'.format(verb)
-        res = requests.post(url, data=payload, files=file, params=self.params)
-        res.raise_for_status
+        res = self.__request(verb, 'POST', url, data=payload, files=file,
+                             params=self.params)
 
         growi_res = res.json()
         # print(json.dumps(growi_res, indent=4))
@@ -216,8 +284,7 @@ class GrowiClient:
         req_params = self.params.copy()
         if params:
             req_params.update(params)
-        res = requests.get(url, params=req_params)
-        res.raise_for_status
+        res = self.__request(verb, 'GET', url, params=req_params)
 
         growi_res = res.json()
         # print(json.dumps(growi_res, indent=4))
@@ -226,6 +293,40 @@ class GrowiClient:
 
         return growi_res
 
+    def __request(self, verb, method, url, **kwargs):
+        """
+        セッションでリクエストを行い、所要時間とリトライ回数を記録する
+
+        Parameters
+        ----------
+        verb : str
+            GROWI API
+        method : str
+            HTTP メソッド
+        url : str
+            URL
+        Retruns
+        -------
+        res : requests.Response
+            レスポンス
+            エラーのステータスの場合はレスポンスを出力して HTTPError を送出する
+        """
+        start = time.perf_counter()
+        res = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        retry = getattr(res.raw, 'retries', None)
+        retries = len(retry.history) if retry else 0
+        latencies, total_retries = self.latencies.get(verb, ([], 0))
+        latencies.append(elapsed)
+        self.latencies[verb] = (latencies, total_retries + retries)
+
+        if not res.ok:
+            print('{} {} : {} {}'.format(method, verb, res.status_code,
+                                         res.text))
+        res.raise_for_status()
+        return res
+
     def __to_path(self, title):
         """
         GROWI ページのバスを返す
@@ -252,6 +353,25 @@ class GrowiClient:
         return path
 
 
+class GrowiRetry(Retry):
+    """
+    GROWI API のリトライ
+
+    POST はサーバーで処理されていない 429 (Too Many Requests) と接続エラーの場合だけリトライする
+    (ページの作成などが重複しないように 5xx のレスポンスや、リクエストの送信後の
+    読み込みのタイムアウト・接続の切断ではリトライしない)
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == 'POST' and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if error and method and method.upper() == 'POST' and not self._is_connection_error(error):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
 class GrowiPage:
     """
     GROWI ページを表す
@@ -15,6 +15,8 @@ parser.add_argument('--growi_port', required=True, help='GROWI API port no.')
 parser.add_argument('--growi_usessl', action='store_true', help='GROWI access with SSL.')
 parser.add_argument('--growi_apikey', required=True, help='GROWI API key.')
 parser.add_argument('--growi_user', required=True, help='GROWI user name.')
+parser.add_argument('--growi_timeout', required=False, default=60, type=float, help='GROWI API read timeout seconds.')
+parser.add_argument('--growi_retries', required=False, default=3, type=int, help='GROWI API retry count.')
 args = parser.parse_args()
 
 
@@ -46,6 +48,15 @@ def migrate_attachments(conn, growi_client, page, id):
             page.replace_attachment(file_row['file_name'], file_url)
 
 
+# GROWI API 毎の所要時間の統計を出力
+def print_latency_stats(growi_client):
+    print('{:<24} {:>6} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'api', 'count', 'retries', 'total', 'mean', 'p50', 'p95', 'max'))
+    for verb, stats in growi_client.get_latency_stats().items():
+        print('{:<24} {count:>6} {retries:>7} {total:>9.3f} {mean:>8.3f} {p50:>8.3f} {p95:>8.3f} {max:>8.3f}'
+              .format(verb, **stats))
+
+
 # Knowledge -> GROWI ページ移行
 def migrage_knowledge(conn, growi_client):
     with conn.cursor(name='knowledges_cursor', cursor_factory=DictCursor) as kb_cur:
@@ -88,10 +99,16 @@ def migrage_knowledge(conn, growi_client):
 with get_connection() as conn:
     # 並び順を後ろの方にするためにドラフトページを先に移行
     growi_client = GrowiClient(
-        args.growi_host, args.growi_port, args.growi_apikey, args.growi_user, args.growi_usessl, True)
+        args.growi_host, args.growi_port, args.growi_apikey, args.growi_user, args.growi_usessl, True,
+        timeout=(10, args.growi_timeout), retries=args.growi_retries)
     migrage_knowledge(conn, growi_client)
+    print_latency_stats(growi_client)
+    growi_client.close()
 
     # 公開ページの移行
     growi_client = GrowiClient(
-        args.growi_host, args.growi_port, args.growi_apikey, args.growi_user, args.growi_usessl)
+        args.growi_host, args.growi_port, args.growi_apikey, args.growi_user, args.growi_usessl,
+        timeout=(10, args.growi_timeout), retries=args.growi_retries)
     migrage_knowledge(conn, growi_client)
+    print_latency_stats(growi_client)
+    growi_client.close()